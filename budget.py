@@ -0,0 +1,182 @@
+# colorcard_kit/budget.py
+"""
+单张图的时间 / 内存预算与取消：
+  - CancelToken + checkpoint：各耗时阶段内部的协作式取消点（停止按钮 / 超时）
+  - BudgetRunner：在常驻子进程中执行，超时或超内存时强制结束并重启子进程，
+    批处理中其它图像不受影响
+  - quarantine：超出预算的图像记录到 quarantine.csv（含原因），之后的运行跳过
+"""
+import os
+import sys
+import csv
+import time
+import multiprocessing as mp
+
+from io_utils import append_csv_row
+
+QUARANTINE = "quarantine.csv"
+
+class Cancelled(Exception):
+    """协作式取消（停止按钮）"""
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+class BudgetExceeded(Cancelled):
+    """超出单图时间/内存预算，或处理该图时子进程异常退出"""
+
+class CancelToken:
+    def __init__(self, stop_event=None, timeout_s=0):
+        self.stop_event = stop_event
+        self.deadline = time.monotonic() + timeout_s if timeout_s and timeout_s > 0 else None
+        self.timeout_s = timeout_s
+
+    def check(self, where=""):
+        if self.stop_event is not None and self.stop_event.is_set():
+            raise Cancelled(f"stopped during {where}")
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded(f"time budget {self.timeout_s:g}s exceeded during {where}")
+
+def checkpoint(cancel, where=""):
+    """cancel 为 None 时不做任何事，便于各阶段无条件调用"""
+    if cancel is not None:
+        cancel.check(where)
+
+# —— 子进程执行
+def limit_memory(mem_mb):
+    """在当前虚拟内存基础上再允许 mem_mb（仅 POSIX；Windows 上只有时间预算生效）"""
+    try:
+        import resource
+    except ImportError:
+        return
+    base = 0
+    try:
+        with open("/proc/self/statm") as f:
+            base = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = base + int(mem_mb) * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+def is_out_of_memory(e):
+    """
+    是否为内存不足：除 MemoryError 外，C 扩展的分配失败不会抛 MemoryError——
+    OpenCV 为 cv2.error（code=-4，Insufficient memory），Pillow 解码器为 OSError（"out of memory"）
+    """
+    if isinstance(e, MemoryError):
+        return True
+    cv2 = sys.modules.get("cv2")
+    if cv2 is not None and isinstance(e, cv2.error):
+        return getattr(e, "code", None) == cv2.Error.StsNoMem
+    return isinstance(e, OSError) and "out of memory" in str(e).lower()
+
+def _worker_main(conn, mem_mb):
+    import cv2  # noqa: F401  预先导入，避免计入首张图的预算
+    if mem_mb > 0:
+        limit_memory(mem_mb)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        fn, args = task
+        try:
+            conn.send(("ok", fn(*args)))
+        except BudgetExceeded as e:
+            conn.send(("budget", e.reason))
+        except Exception as e:
+            if isinstance(e, MemoryError) or (mem_mb > 0 and is_out_of_memory(e)):
+                conn.send(("budget", f"memory budget {mem_mb}MB exceeded ({type(e).__name__}: {e})"))
+            else:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+
+class BudgetRunner:
+    """
+    常驻子进程执行器：run(fn, *args) 在子进程里执行 fn（需为模块级函数）。
+      timeout_s：单次调用的硬超时（0 = 不限）；超时即结束子进程并在下次调用时重启
+      mem_mb：子进程可额外使用的内存（0 = 不限）
+      stop_event：置位后立即结束当前调用（抛 Cancelled）
+    """
+    def __init__(self, timeout_s=0, mem_mb=0, stop_event=None):
+        self.timeout_s = timeout_s
+        self.mem_mb = mem_mb
+        self.stop_event = stop_event
+        self._ctx = mp.get_context("spawn")
+        self._proc = self._conn = None
+
+    def _ensure(self):
+        if self._proc is not None and self._proc.is_alive():
+            return
+        parent, child = self._ctx.Pipe()
+        self._proc = self._ctx.Process(target=_worker_main, args=(child, self.mem_mb), daemon=True)
+        self._proc.start()
+        child.close()
+        self._conn = parent
+
+    def _kill(self):
+        if self._proc is not None:
+            self._proc.kill()
+            self._proc.join(timeout=5)
+        if self._conn is not None:
+            self._conn.close()
+        self._proc = self._conn = None
+
+    def run(self, fn, *args):
+        self._ensure()
+        self._conn.send((fn, args))
+        t0 = time.monotonic()
+        while True:
+            if self._conn.poll(0.1):
+                try:
+                    status, payload = self._conn.recv()
+                except EOFError:
+                    status, payload = "died", None
+                break
+            if self.stop_event is not None and self.stop_event.is_set():
+                self._kill()
+                raise Cancelled("stopped")
+            if self.timeout_s and time.monotonic() - t0 > self.timeout_s:
+                self._kill()
+                raise BudgetExceeded(f"time budget {self.timeout_s:g}s exceeded (worker killed)")
+            if not self._proc.is_alive():
+                status, payload = "died", None
+                break
+
+        if status == "ok":
+            return payload
+        if status == "budget":
+            raise BudgetExceeded(payload)
+        if status == "died":
+            code = self._proc.exitcode if self._proc is not None else None
+            self._kill()
+            raise BudgetExceeded(f"worker exited unexpectedly (exit code {code})")
+        raise RuntimeError(payload)
+
+    def close(self):
+        if self._proc is not None and self._proc.is_alive():
+            try:
+                self._conn.send(None)
+                self._proc.join(timeout=2)
+            except (OSError, BrokenPipeError):
+                pass
+        self._kill()
+
+# —— 隔离名单
+def quarantine(output_dir, image_path, reason):
+    append_csv_row(os.path.join(output_dir, QUARANTINE), {
+        "image": image_path,
+        "reason": reason,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    })
+
+def load_quarantine(output_dir):
+    path = os.path.join(output_dir, QUARANTINE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="", encoding="utf-8") as f:
+        return {row["image"]: row["reason"] for row in csv.DictReader(f)}
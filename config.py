@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Tuple
 import math
 
 @dataclass
@@ -15,15 +16,34 @@ class PipelineConfig:
     # 每格中心采样
     sample_count: int = 100
     sample_center_area: float = 0.40  # (0,1] 中心采样面积比例
+    # 每格统计方式：'sample'（随机抽样鲁棒均值）| 'exact'（积分图全像素）| 'clipped'（exact + 按方差剔除离群）
+    # 开销：exact 对色卡区域求一次积分图，之后每格 O(1)；clipped 还需逐像素扫描每格中心区域
+    # （每格 O(像素数)，全分辨率大图上明显慢于 exact，但通常仍快于整图解码）
+    cell_stats: str = "sample"
+    clip_sigma: float = 2.5
 
     # 边缘检测
     sobel_ksize: int = 3
     edge_thresh: int = 50
 
+    # 检测级联：置信度不足时逐级尝试 Otsu / 自适应阈值 / 闭运算 / 多尺度
+    detect_cascade: bool = True
+    cascade_min_confidence: float = 0.6     # 达到即停止升级
+    # 各级最优仍低于此值 → 视为失败（转手动回退）。默认 0：与旧检测器一样，只要找到两块就接受；
+    # 调高可拦下低置信度的误检，但会比旧检测器产生更多手动回退
+    cascade_accept_confidence: float = 0.0
+    cascade_close_ksize: int = 5
+    cascade_scales: Tuple[float, ...] = (0.5, 1.5)
+
     # 特征输出模式：'log_ratio' | 'ratio' | 'multi'
     feature_mode: str = "log_ratio"
     per_image_channel_norm: bool = True
     save_extras: bool = True
+    save_vis: bool = True  # False：不出可视化图（也不导入 matplotlib）
+    # 数据集级标准化：'' 关闭 | 'cell'（逐通道逐格）| 'channel'（逐通道）；
+    # 统计来自之前运行导出的 dataset_stats.npz，启用时替代 per_image_channel_norm
+    dataset_norm: str = ""
+    dataset_stats_path: str = ""
 
     # —— 新增：手动框选回退 & 强制手动
     allow_manual: bool = True
@@ -35,6 +55,13 @@ class PipelineConfig:
     raw_use_camera_wb: bool = True         # 使用相机白平衡
     raw_output_bps: int = 8                # 输出 8-bit（与现有流程对齐）
 
+    # —— 非 RAW 低内存读取：检测图用 JPEG 草图/TIFF 条带降采样解码，全分辨率只读色卡 ROI
+    roi_reads: bool = True
+
+    # —— 单图预算：超出即结束该图并记入 quarantine.csv（0 = 不限）
+    image_timeout_s: float = 120.0
+    image_mem_mb: int = 0
+
     @property
     def sample_center_side_ratio(self) -> float:
         a = max(0.0, min(1.0, float(self.sample_center_area)))
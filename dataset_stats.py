@@ -0,0 +1,178 @@
+# colorcard_kit/dataset_stats.py
+import os
+import argparse
+import numpy as np
+
+class RunningStats:
+    """
+    逐元素在线统计（Welford）：均值 / 方差 / 最小值 / 最大值。
+    可用 merge() 合并不同进程或分片的结果（Chan 并行合并公式），无需回读原始 .npy。
+    """
+    def __init__(self, shape=None):
+        self.n = 0
+        self.mean = self.m2 = self.min = self.max = None
+        if shape is not None:
+            self._init(shape)
+
+    def _init(self, shape):
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.mean is None:
+            self._init(x.shape)
+        elif x.shape != self.mean.shape:
+            raise ValueError(f"shape mismatch: {x.shape} vs {self.mean.shape}")
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        np.minimum(self.min, x, out=self.min)
+        np.maximum(self.max, x, out=self.max)
+        return self
+
+    def merge(self, other: "RunningStats"):
+        if other.n == 0:
+            return self
+        if self.n == 0:
+            self.n = other.n
+            self.mean, self.m2 = other.mean.copy(), other.m2.copy()
+            self.min, self.max = other.min.copy(), other.max.copy()
+            return self
+        if other.mean.shape != self.mean.shape:
+            raise ValueError(f"shape mismatch: {other.mean.shape} vs {self.mean.shape}")
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.n / n)
+        self.m2 = self.m2 + other.m2 + delta**2 * (self.n * other.n / n)
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        self.n = n
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.n, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def channel_summary(self):
+        """
+        按通道（第 0 维）汇总所有格子：把每格视作一个子样本合并，
+        返回 mean/std/min/max，形状均为 (C,)
+        """
+        axes = tuple(range(1, self.mean.ndim))
+        cells = int(np.prod(self.mean.shape[1:])) if axes else 1
+        mean = self.mean.mean(axis=axes) if axes else self.mean.copy()
+        # 总平方和 = 各格组内平方和 + 各格均值相对通道均值的组间平方和
+        between = ((self.mean - mean.reshape((-1,) + (1,) * len(axes)))**2).sum(axis=axes) if axes else 0.0
+        m2 = (self.m2.sum(axis=axes) if axes else self.m2) + self.n * between
+        std = np.sqrt(m2 / max(self.n * cells, 1))
+        return {
+            "mean": mean,
+            "std": std,
+            "min": self.min.min(axis=axes) if axes else self.min.copy(),
+            "max": self.max.max(axis=axes) if axes else self.max.copy(),
+        }
+
+class DatasetStats:
+    """
+    一次运行的数据集级统计：name → RunningStats（如 features_raw / ref_346 / sample_346）
+    """
+    def __init__(self, feature_mode=None):
+        self.feature_mode = feature_mode
+        self.items = {}
+
+    def update(self, name, x):
+        self.items.setdefault(name, RunningStats()).update(x)
+
+    def merge(self, other: "DatasetStats"):
+        if self.feature_mode is None:
+            self.feature_mode = other.feature_mode
+        elif other.feature_mode not in (None, self.feature_mode):
+            raise ValueError(f"feature_mode mismatch: {other.feature_mode} vs {self.feature_mode}")
+        for name, rs in other.items.items():
+            self.items.setdefault(name, RunningStats()).merge(rs)
+        return self
+
+    def __getitem__(self, name):
+        return self.items[name]
+
+    def save(self, path):
+        """导出为 npz：<name>__n/mean/m2/min/max/std 以及按通道汇总的 <name>__ch_*"""
+        out = {"feature_mode": np.array(self.feature_mode or "")}
+        for name, rs in self.items.items():
+            if rs.n == 0:
+                continue
+            out.update({f"{name}__n": np.array(rs.n), f"{name}__mean": rs.mean, f"{name}__m2": rs.m2,
+                        f"{name}__min": rs.min, f"{name}__max": rs.max, f"{name}__std": rs.std})
+            for k, v in rs.channel_summary().items():
+                out[f"{name}__ch_{k}"] = v
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.savez(path, **out)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            ds = cls(str(data["feature_mode"]) or None)
+            names = {k.split("__")[0] for k in data.files if k.endswith("__n")}
+            for name in names:
+                rs = RunningStats()
+                rs.n = int(data[f"{name}__n"])
+                rs.mean, rs.m2 = data[f"{name}__mean"], data[f"{name}__m2"]
+                rs.min, rs.max = data[f"{name}__min"], data[f"{name}__max"]
+                ds.items[name] = rs
+        return ds
+
+_LOADED = {}  # abspath -> (mtime_ns, DatasetStats)
+
+def load_cached(path):
+    """同一进程内复用已读取的统计文件（批处理/服务 worker 中逐图复用）；文件被改写后重新读取"""
+    key = os.path.abspath(path)
+    mtime = os.stat(key).st_mtime_ns
+    hit = _LOADED.get(key)
+    if hit is None or hit[0] != mtime:
+        hit = _LOADED[key] = (mtime, DatasetStats.load(key))
+    return hit[1]
+
+def apply_dataset_norm(X_raw, stats: DatasetStats, level="cell", name="features_raw", eps=1e-6,
+                       feature_mode=None):
+    """
+    用数据集级统计标准化特征：
+      level='cell'   ：逐通道逐格 (X - mean) / std
+      level='channel'：逐通道 (X - mean_c) / std_c
+    feature_mode 给出时须与统计文件记录的一致（不同模式的特征形状可能相同，但含义不同）
+    """
+    if feature_mode is not None and stats.feature_mode is not None and feature_mode != stats.feature_mode:
+        raise ValueError(f"feature_mode {feature_mode} does not match stats ({stats.feature_mode})")
+    rs = stats[name]
+    if X_raw.shape != rs.mean.shape:
+        raise ValueError(f"feature shape {X_raw.shape} does not match stats {rs.mean.shape}")
+    if level == "cell":
+        mean, std = rs.mean, rs.std
+    elif level == "channel":
+        ch = rs.channel_summary()
+        shape = (-1,) + (1,) * (X_raw.ndim - 1)
+        mean, std = ch["mean"].reshape(shape), ch["std"].reshape(shape)
+    else:
+        raise ValueError(f"Unknown dataset_norm: {level}")
+    return ((X_raw - mean) / (std + eps)).astype(np.float32)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="合并多个 worker / 分片导出的 dataset_stats.npz")
+    ap.add_argument("out")
+    ap.add_argument("inputs", nargs="+")
+    args = ap.parse_args(argv)
+    total = DatasetStats()
+    for p in args.inputs:
+        total.merge(DatasetStats.load(p))
+    print(f"[Stats] merged {len(args.inputs)} file(s) → {total.save(args.out)}")
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,28 @@
+import io
+import time
 import numpy as np
 import cv2
-from PIL import Image
+from PIL import Image, TiffImagePlugin, TiffTags
 from config import PipelineConfig
+from budget import checkpoint
 
-# 可选 RAW 支持
-try:
-    import rawpy  # pip install rawpy
-    _HAS_RAWPY = True
-except Exception:
-    _HAS_RAWPY = False
+# 可选 RAW 支持（首次读取 RAW 时才探测 rawpy，避免拖慢导入）
+_RAWPY = None
+
+def _get_rawpy():
+    global _RAWPY
+    if _RAWPY is None:
+        try:
+            import rawpy  # pip install rawpy
+            _RAWPY = rawpy
+        except Exception:
+            _RAWPY = False
+    return _RAWPY or None
 
 def _read_raw_linear(path, cfg: PipelineConfig):
     """使用 rawpy 以线性（无伽马）方式解码 RAW，返回 PIL.Image RGB。"""
-    if not _HAS_RAWPY:
+    rawpy = _get_rawpy()
+    if rawpy is None:
         return None, "rawpy not installed"
     try:
         with rawpy.imread(path) as raw:
@@ -33,6 +43,11 @@ def _read_raw_linear(path, cfg: PipelineConfig):
     except Exception as e:
         return None, str(e)
 
+RAW_EXTS = {"cr2", "nef", "arw", "dng", "raf", "rw2", "orf", "cr3"}
+
+def is_raw_path(path):
+    return str(path).split(".")[-1].lower() in RAW_EXTS
+
 def load_image(path, cfg: PipelineConfig):
     """
     统一读取接口：
@@ -40,9 +55,7 @@ def load_image(path, cfg: PipelineConfig):
       - 否则用 PIL 常规读取（JPEG/PNG/TIFF 等）
     返回 PIL.Image（RGB）
     """
-    suffix = str(path).split(".")[-1].lower()
-    is_raw = suffix in {"cr2", "nef", "arw", "dng", "raf", "rw2", "orf", "cr3"}
-    if is_raw and cfg.prefer_raw_linear:
+    if is_raw_path(path) and cfg.prefer_raw_linear:
         pil, err = _read_raw_linear(path, cfg)
         if pil is not None:
             return pil
@@ -55,23 +68,251 @@ def resize_keep_h(im, target_h):
     new_w = int(target_h * (orig_w / orig_h))
     return im.resize((new_w, target_h)), (orig_w, orig_h, new_w, target_h)
 
-def detect_regions_pair(im_gray, cfg: PipelineConfig):
+# —— 非 RAW 的低内存读取：JPEG 草图解码 / 只解码到 ROI 下沿；TIFF 按条带或分块只读 ROI
+_RAW_BPP = {"L": 1, "RGB": 3, "RGBX": 4, "RGBA": 4}
+# 压缩 TIFF 取子区域时需原样保留的数据布局标签（位深/压缩/光度/预测器/分块尺寸/JPEG 表等）
+_TIFF_LAYOUT_TAGS = (258, 259, 262, 266, 277, 278, 284, 317, 320, 322, 323, 338, 339, 347, 530, 531, 532)
+
+def _move_tile(t, extents, offset):
+    """改写 tile 的范围/偏移；新版 Pillow 要求 ImageFile._Tile（load 时按 .offset 访问）"""
+    if hasattr(t, "_replace"):
+        return t._replace(extents=extents, offset=offset)
+    return (t[0], extents, offset, t[3])
+
+def _tiff_blocks(im):
+    """压缩 TIFF 的条带/分块布局：(块宽, 块高, 偏移, 字节数, 是否分块)；只有一块或平面分离时返回 None"""
+    tags = im.tag_v2
+    w, h = im.size
+    if tags.get(284, 1) != 1:
+        return None
+    if 324 in tags and 325 in tags:
+        layout = (tags[322], tags[323], tags[324], tags[325], True)
+    elif 273 in tags and 279 in tags:
+        layout = (w, min(tags.get(278, h), h), tags[273], tags[279], False)
+    else:
+        return None
+    bw, bh, offsets = layout[:3]
+    n = -(-w // bw) * -(-h // bh)
+    if n < 2 or len(offsets) != n:
+        return None
+    return layout
+
+def _libtiff_region(path, im, rect):
     """
-    基于 Sobel + 阈值 + 连通域：
-      - 取面积 top2 的连通域作为两块色卡
-      - y 均值更小者为 ref_box，上方；另一者 sample_box
-    返回：edges, ref_box(4x2), sample_box(4x2)
+    压缩 TIFF（LZW / Deflate 等，Pillow 整幅交给 libtiff 解码）：
+    把与 rect 相交的条带/分块原样拷进一个内存中的小 TIFF，只解码这些块。
+    """
+    layout = _tiff_blocks(im)
+    if layout is None:
+        return None
+    bw, bh, offsets, counts, tiled = layout
+    w, h = im.size
+    x1, y1, x2, y2 = rect
+    across = -(-w // bw)
+    c1, c2 = x1 // bw, (x2 - 1) // bw + 1
+    r1, r2 = y1 // bh, (y2 - 1) // bh + 1
+    with open(path, "rb") as f:
+        prefix = f.read(2)  # 沿用原文件字节序（16 位等样本按它存储）
+        chunks = []
+        for b in (r * across + c for r in range(r1, r2) for c in range(c1, c2)):
+            f.seek(offsets[b])
+            chunks.append(f.read(counts[b]))
+
+    src = im.tag_v2
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=prefix)
+    for tag in _TIFF_LAYOUT_TAGS:
+        if tag in src:
+            ifd[tag] = src[tag]
+            ifd.tagtype[tag] = src.tagtype[tag]
+    # 分块总是整块存储；条带的最后一条可能不足 rowsperstrip 行
+    sizes = {256: (c2 - c1) * bw if tiled else w,
+             257: (r2 - r1) * bh if tiled else min(r2 * bh, h) - r1 * bh}
+    rel = list(np.cumsum([0] + [len(c) for c in chunks[:-1]]).tolist())
+    off_tag, cnt_tag = (324, 325) if tiled else (273, 279)
+    sizes[cnt_tag] = tuple(len(c) for c in chunks)
+    sizes[off_tag] = tuple(rel)
+    for tag, v in sizes.items():
+        ifd[tag] = v
+        ifd.tagtype[tag] = TiffTags.LONG
+    if tiled:
+        # Pillow 只会自动平移 StripOffsets；分块偏移按 IFD 长度自行换算成绝对位置
+        base = 8 + len(ifd.tobytes(8))
+        ifd[off_tag] = tuple(base + r for r in rel)
+    buf = io.BytesIO()
+    ifd.save(buf)
+    buf.write(b"".join(chunks))
+    buf.seek(0)
+    sub = Image.open(buf)
+    sub.load()
+    ox, oy = c1 * bw, r1 * bh
+    return sub.crop((x1 - ox, y1 - oy, x2 - ox, y2 - oy))
+
+def _tiff_region(path, rect):
+    """
+    只解码 TIFF 中与 rect=(x1,y1,x2,y2) 相交的条带/分块，返回该区域 PIL.Image；
+    未压缩与压缩（LZW / Deflate 等）的多条带/分块布局都支持；
+    整幅只有一块的压缩 TIFF 无块可跳过，返回 None，由调用方整图解码。
+    """
+    im = Image.open(path)
+    if im.format != "TIFF":
+        return None
+    x1, y1, x2, y2 = rect
+    tiles = list(im.tile)
+    try:
+        if len(tiles) == 1 and tiles[0][0] == "libtiff":
+            return _libtiff_region(path, im, rect)
+        if len(tiles) == 1 and tiles[0][0] == "raw":
+            # 单块未压缩：按行字节偏移直接定位，只读需要的行
+            codec, (tx1, ty1, tx2, ty2), offset, args = tiles[0]
+            bpp = _RAW_BPP.get(args[0])
+            stride = args[1] if len(args) > 1 else 0
+            orientation = args[2] if len(args) > 2 else 1
+            if bpp is None or orientation != 1 or (tx1, ty1) != (0, 0):
+                return None
+            row = stride or (tx2 - tx1) * bpp
+            h = y2 - y1
+            im._size = (tx2 - tx1, h)
+            im.tile = [_move_tile(tiles[0], (0, 0, tx2 - tx1, h), offset + y1 * row)]
+            im.load()
+            return im.crop((x1, 0, x2, h))
+        if len(tiles) > 1:
+            # 多条带/分块：只保留相交的块，平移到它们的外接框内解码
+            hit = [t for t in tiles
+                   if t[1][0] < x2 and t[1][2] > x1 and t[1][1] < y2 and t[1][3] > y1]
+            if not hit:
+                return None
+            ux1 = min(t[1][0] for t in hit); uy1 = min(t[1][1] for t in hit)
+            ux2 = max(t[1][2] for t in hit); uy2 = max(t[1][3] for t in hit)
+            im._size = (ux2 - ux1, uy2 - uy1)
+            im.tile = [_move_tile(t, (t[1][0]-ux1, t[1][1]-uy1, t[1][2]-ux1, t[1][3]-uy1), t[2])
+                       for t in hit]
+            im.load()
+            return im.crop((x1 - ux1, y1 - uy1, x2 - ux1, y2 - uy1))
+    except Exception as e:
+        print(f"[TIFF region fallback] {e}")
+    return None
+
+def _tiff_regions_supported(im):
+    """TIFF 布局是否支持 _tiff_region（未压缩单块，或未压缩/压缩的多条带、分块）"""
+    tiles = im.tile
+    if len(tiles) == 1:
+        t = tiles[0]
+        if t[0] == "libtiff":
+            return _tiff_blocks(im) is not None
+        return t[0] == "raw" and t[3][0] in _RAW_BPP and tuple(t[1][:2]) == (0, 0)
+    return len(tiles) > 1
+
+def _jpeg_rows(path, y2):
+    """
+    JPEG 按行顺序解码：只解码前 y2 行（ROI 下沿以下的行不解码、不占内存）。
+    不是 JPEG 或解码失败时返回 None。
+    """
+    im = Image.open(path)
+    if im.format != "JPEG" or len(im.tile) != 1:
+        return None
+    w, h = im.size
+    if y2 < h:
+        im._size = (w, y2)
+        im.tile = [_move_tile(im.tile[0], (0, 0, w, y2), im.tile[0][2])]
+    try:
+        im.load()
+    except OSError as e:
+        # 提前停止时 libjpeg 在收尾阶段报错（扫描行未读完），此时所需各行已全部解码；
+        # 其它错误（如文件截断）交给整图解码处理
+        if y2 >= h or im.im is None or "broken data stream" not in str(e):
+            print(f"[JPEG rows fallback] {e}")
+            return None
+    return im if im.mode == "RGB" else im.convert("RGB")  # convert 总会复制一份
+
+def supports_roi_reads(path):
+    """非 RAW 且能低成本降采样解码的格式：JPEG（draft），以及支持条带/分块读取的 TIFF"""
+    if is_raw_path(path):
+        return False
+    try:
+        with Image.open(path) as im:
+            if im.format == "JPEG":
+                return True
+            return im.format == "TIFF" and _tiff_regions_supported(im)
+    except Exception:
+        return False
+
+def load_reduced(path, target_h, cancel=None):
+    """
+    读取缩小后的 RGB 图（用于检测/预览），不保留全分辨率整图：
+      - JPEG：draft 模式在 DCT 域按 1/2、1/4、1/8 直接解码
+      - 支持条带读取的 TIFF：逐条带解码并降采样
+      - 其它：整图解码后缩放（与原流程相同）
+    返回：resized(PIL RGB), (orig_w, orig_h, new_w, new_h)
+    """
+    im = Image.open(path)
+    ow, oh = im.size
+    nw = int(target_h * (ow / oh))
+    if im.format == "JPEG":
+        im.draft("RGB", (nw, target_h))
+        return im.convert("RGB").resize((nw, target_h)), (ow, oh, nw, target_h)
+    if im.format == "TIFF":
+        f = max(1, oh // (target_h * 2))
+        band = f * 256
+        parts = []
+        for y in range(0, oh, band):
+            checkpoint(cancel, "reduced decode")
+            part = _tiff_region(path, (0, y, ow, min(oh, y + band)))
+            if part is None:
+                parts = None
+                break
+            parts.append(np.array(part.convert("RGB").reduce(f)))
+        if parts:
+            small = Image.fromarray(np.vstack(parts), mode="RGB")
+            return small.resize((nw, target_h)), (ow, oh, nw, target_h)
+    return resize_keep_h(im.convert("RGB"), target_h)
+
+def read_regions(path, rects, cfg: PipelineConfig, cancel=None):
+    """
+    读取全分辨率下的若干矩形区域 rects=[(x1,y1,x2,y2), ...]，返回 RGB ndarray 列表。
+      - 多条带/分块 TIFF（含 LZW / Deflate 压缩）：只解码与各区域相交的块
+      - JPEG：熵编码只能从首行顺序解码，只解码到所有区域的最下沿为止（左右与上方的行仍需解码）
+      - 其它：整图解码一次裁出全部区域后立即释放整图
     """
-    k = cfg.sobel_ksize
-    gx = cv2.Sobel(im_gray, cv2.CV_64F, 1, 0, ksize=k)
-    gy = cv2.Sobel(im_gray, cv2.CV_64F, 0, 1, ksize=k)
+    if not is_raw_path(path):
+        crops = []
+        for r in rects:
+            checkpoint(cancel, "roi read")
+            part = _tiff_region(path, r)
+            if part is None:
+                break
+            crops.append(np.array(part.convert("RGB")))
+        else:
+            return crops
+        checkpoint(cancel, "roi read")
+        rows = _jpeg_rows(path, max(r[3] for r in rects))
+        if rows is not None:
+            crops = [np.array(rows.crop(r)) for r in rects]
+            del rows
+            return crops
+    checkpoint(cancel, "roi read")
+    full = load_image(path, cfg)
+    checkpoint(cancel, "roi read")
+    crops = [np.array(full.crop(r)) for r in rects]
+    del full
+    return crops
+
+def sobel_magnitude(im_gray, ksize):
+    """Sobel 梯度幅值，归一化到 uint8（只依赖 sobel_ksize，可按 ksize 复用）"""
+    gx = cv2.Sobel(im_gray, cv2.CV_64F, 1, 0, ksize=ksize)
+    gy = cv2.Sobel(im_gray, cv2.CV_64F, 0, 1, ksize=ksize)
     mag = np.sqrt(gx**2 + gy**2)
-    mag = np.uint8(255 * mag / (mag.max() + 1e-8))
-    _, binary = cv2.threshold(mag, cfg.edge_thresh, 255, cv2.THRESH_BINARY)
+    return np.uint8(255 * mag / (mag.max() + 1e-8))
 
+def _boxes_from_binary(binary):
+    """
+    连通域：
+      - 取面积 top2 的连通域作为两块色卡
+      - y 均值更小者为 ref_box，上方；另一者 sample_box
+    返回：ref_box(4x2), sample_box(4x2)；失败时 (None, None)
+    """
     num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
     if num_labels < 3:
-        return mag, None, None
+        return None, None
 
     # 找面积 Top2
     areas = stats[1:, cv2.CC_STAT_AREA]
@@ -86,8 +327,126 @@ def detect_regions_pair(im_gray, cfg: PipelineConfig):
             boxes.append(box)
 
     if len(boxes) != 2:
-        return mag, None, None
+        return None, None
 
     y_mean = [np.mean(b[:, 1]) for b in boxes]
     ref_box, sample_box = (boxes[0], boxes[1]) if y_mean[0] < y_mean[1] else (boxes[1], boxes[0])
+    return ref_box, sample_box
+
+def detect_from_magnitude(mag, edge_thresh):
+    """固定阈值二值化 + 连通域，返回 ref_box, sample_box"""
+    _, binary = cv2.threshold(mag, edge_thresh, 255, cv2.THRESH_BINARY)
+    return _boxes_from_binary(binary)
+
+def detect_regions_pair(im_gray, cfg: PipelineConfig):
+    """
+    基于 Sobel + 阈值 + 连通域检测上下两块色卡
+    返回：edges, ref_box(4x2), sample_box(4x2)
+    """
+    mag = sobel_magnitude(im_gray, cfg.sobel_ksize)
+    ref_box, sample_box = detect_from_magnitude(mag, cfg.edge_thresh)
     return mag, ref_box, sample_box
+
+def score_pair(ref_box, sample_box, shape):
+    """
+    两块候选区域的置信度（0~1），各项取几何平均：
+      - size：单块面积占图像比例在合理范围内
+      - similar：两块面积接近（上下两张同规格色卡）
+      - aspect：两块长宽比接近
+      - separated：上下不重叠
+    """
+    if ref_box is None or sample_box is None:
+        return 0.0
+    img_area = float(shape[0] * shape[1])
+
+    def geom(box):
+        rect = cv2.minAreaRect(box.astype(np.float32))
+        w, h = rect[1]
+        return w * h, max(w, h) / max(min(w, h), 1.0), np.min(box[:, 1]), np.max(box[:, 1])
+
+    a1, r1, y1a, y1b = geom(ref_box)
+    a2, r2, y2a, y2b = geom(sample_box)
+    if a1 <= 0 or a2 <= 0:
+        return 0.0
+
+    def size_score(a):
+        f = a / img_area
+        if f < 0.02:
+            return f / 0.02
+        if f > 0.45:
+            return max(0.0, (0.9 - f) / 0.45)
+        return 1.0
+
+    size = size_score(a1) * size_score(a2)
+    similar = min(a1, a2) / max(a1, a2)
+    aspect = min(r1, r2) / max(r1, r2)
+    overlap = max(0.0, min(y1b, y2b) - max(y1a, y2a))
+    separated = max(0.0, 1.0 - overlap / max(min(y1b - y1a, y2b - y2a), 1.0))
+    return float((size * similar * aspect * separated) ** 0.25)
+
+def _detect_scaled(im_gray, cfg: PipelineConfig, factor):
+    """在缩放后的灰度图上检测，再映射回原坐标"""
+    h, w = im_gray.shape[:2]
+    g = cv2.resize(im_gray, (max(1, int(w * factor)), max(1, int(h * factor))),
+                   interpolation=cv2.INTER_AREA if factor < 1 else cv2.INTER_LINEAR)
+    ref_box, sample_box = detect_from_magnitude(sobel_magnitude(g, cfg.sobel_ksize), cfg.edge_thresh)
+    if ref_box is None or sample_box is None:
+        return None, None
+    return (ref_box / factor).round().astype(int), (sample_box / factor).round().astype(int)
+
+def _cascade_stages(im_gray, mag, cfg: PipelineConfig):
+    """由便宜到昂贵的检测策略；惰性生成，仅在前级置信度不足时才执行"""
+    yield "default", lambda: detect_from_magnitude(mag, cfg.edge_thresh)
+
+    otsu_bin = []  # Otsu 二值图只算一次，闭运算级复用
+
+    def otsu():
+        if not otsu_bin:
+            _, b = cv2.threshold(mag, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+            otsu_bin.append(b)
+        return otsu_bin[0]
+    yield "otsu", lambda: _boxes_from_binary(otsu())
+
+    def adaptive():
+        block = max(3, (min(mag.shape[:2]) // 16) | 1)
+        b = cv2.adaptiveThreshold(mag, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block, -10)
+        return _boxes_from_binary(b)
+    yield "adaptive", adaptive
+
+    def close():
+        k = cv2.getStructuringElement(cv2.MORPH_RECT, (cfg.cascade_close_ksize, cfg.cascade_close_ksize))
+        return _boxes_from_binary(cv2.morphologyEx(otsu(), cv2.MORPH_CLOSE, k))
+    yield "close", close
+
+    for f in cfg.cascade_scales:
+        yield f"scale_{f:g}", (lambda f=f: _detect_scaled(im_gray, cfg, f))
+
+def detect_regions_cascade(im_gray, cfg: PipelineConfig, cancel=None, mag=None):
+    """
+    级联检测：默认策略 → Otsu → 自适应阈值 → 形态学闭运算 → 多尺度，
+    置信度达到 cascade_min_confidence 即停止；否则取各级最优，
+    最优置信度低于 cascade_accept_confidence 视为失败（交给手动回退）。
+    返回：edges, ref_box, sample_box, info
+      info = {"level": 采用的策略名或 None, "confidence": float,
+              "stages": [(策略名, 置信度, 耗时ms), ...]}
+    mag 可传入已算好的梯度幅值（如参数扫描中复用），否则按 cfg.sobel_ksize 计算
+    """
+    if mag is None:
+        mag = sobel_magnitude(im_gray, cfg.sobel_ksize)
+    best = (None, 0.0, None, None)
+    stages = []
+    for name, run in _cascade_stages(im_gray, mag, cfg):
+        checkpoint(cancel, f"detect/{name}")
+        t0 = time.perf_counter()
+        ref_box, sample_box = run()
+        conf = score_pair(ref_box, sample_box, im_gray.shape)
+        stages.append((name, conf, (time.perf_counter() - t0) * 1000.0))
+        if conf > best[1]:
+            best = (name, conf, ref_box, sample_box)
+        if conf >= cfg.cascade_min_confidence:
+            break
+
+    level, conf, ref_box, sample_box = best
+    if conf < cfg.cascade_accept_confidence:
+        level, ref_box, sample_box = None, None, None
+    return mag, ref_box, sample_box, {"level": level, "confidence": conf, "stages": stages}
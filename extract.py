@@ -1,6 +1,7 @@
 import numpy as np
 import cv2
 from config import PipelineConfig
+from budget import checkpoint
 
 def shrink_quad(box, crop_long_ratio, crop_short_ratio):
     x_min, y_min = np.min(box, axis=0)
@@ -30,11 +31,10 @@ def _robust_center_pixels(patch_bgr, sample_count):
         sel = np.tile(sel, (pad_reps, 1))[:sample_count]
     return sel.astype(np.float32)
 
-def extract_card_means(image_bgr, mapped_box, cfg: PipelineConfig, draw_grid=True):
+def _cell_rects(box, cfg: PipelineConfig):
     """
-    在原始图像中对 4×6 网格取“中心 area% 面积”，做鲁棒均值，输出 (3,4,6)
+    返回 [(r, c, (x1,y1,x2,y2), (cx1,cy1,cx2,cy2)), ...]：每格外框与中心采样区域
     """
-    box = shrink_quad(mapped_box, cfg.card_crop_long, cfg.card_crop_short)
     x_min, y_min = np.min(box, axis=0)
     x_max, y_max = np.max(box, axis=0)
     W, H = x_max - x_min, y_max - y_min
@@ -47,7 +47,7 @@ def extract_card_means(image_bgr, mapped_box, cfg: PipelineConfig, draw_grid=Tru
     dx = int(cw * margin_ratio)
     dy = int(ch * margin_ratio)
 
-    means = np.zeros((3, rows, cols), dtype=np.float32)
+    rects = []
     for r in range(rows):
         for c in range(cols):
             x1 = x_min + c * cw
@@ -64,15 +64,90 @@ def extract_card_means(image_bgr, mapped_box, cfg: PipelineConfig, draw_grid=Tru
                 # 若面积系数极小导致中心区域无效，退回到 1px 安全取值
                 cx1, cy1 = x1 + cw//4, y1 + ch//4
                 cx2, cy2 = x2 - cw//4, y2 - ch//4
+            rects.append((r, c, (x1, y1, x2, y2), (cx1, cy1, cx2, cy2)))
+    return rects
 
+def _integral_stats(image_bgr, centers):
+    """
+    积分图：对 ROI 求一次 sum / sqsum，之后每格均值与方差 O(1)。
+    centers: (N,4) 的 (cx1,cy1,cx2,cy2)；返回 mean, var 均为 (N,3) BGR
+    """
+    h, w = image_bgr.shape[:2]
+    c = np.asarray(centers, dtype=np.int64)
+    c[:, [0, 2]] = np.clip(c[:, [0, 2]], 0, w)
+    c[:, [1, 3]] = np.clip(c[:, [1, 3]], 0, h)
+    # 只对所有格子的外接区域做积分
+    rx1, ry1 = c[:, 0].min(), c[:, 1].min()
+    rx2, ry2 = max(c[:, 2].max(), rx1 + 1), max(c[:, 3].max(), ry1 + 1)
+    roi = np.ascontiguousarray(image_bgr[ry1:ry2, rx1:rx2])
+    s, sq = cv2.integral2(roi, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+    s = s.reshape(s.shape[0], s.shape[1], -1)
+    sq = sq.reshape(sq.shape[0], sq.shape[1], -1)
+
+    x1, y1 = c[:, 0] - rx1, c[:, 1] - ry1
+    x2, y2 = c[:, 2] - rx1, c[:, 3] - ry1
+    n = np.maximum((x2 - x1) * (y2 - y1), 1).astype(np.float64)[:, None]
+    total = s[y2, x2] - s[y1, x2] - s[y2, x1] + s[y1, x1]
+    total_sq = sq[y2, x2] - sq[y1, x2] - sq[y2, x1] + sq[y1, x1]
+    mean = total / n
+    var = np.maximum(total_sq / n - mean**2, 0.0)
+    return mean, var
+
+def _clipped_stats(patch_bgr, mean, var, k):
+    """以积分图的均值/方差为中心，剔除 |x-mean| > k·std 的像素后再求均值与方差"""
+    px = patch_bgr.reshape(-1, 3).astype(np.float32)
+    if px.shape[0] == 0:
+        return mean, var
+    std = np.sqrt(var) + 1e-6
+    keep = np.all(np.abs(px - mean) <= k * std, axis=1)
+    if not np.any(keep):
+        return mean, var
+    sel = px[keep]
+    return sel.mean(axis=0), sel.var(axis=0)
+
+def extract_card_stats(image_bgr, mapped_box, cfg: PipelineConfig, draw_grid=True, cancel=None):
+    """
+    在原始图像中对网格取“中心 area% 面积”，输出每格 RGB 均值与方差，均为 (3,rows,cols)
+    cfg.cell_stats:
+      - 'sample' ：随机抽 sample_count 个像素做鲁棒均值（原方式）
+      - 'exact'  ：积分图求中心区域全部像素的精确均值/方差，每格 O(1)
+      - 'clipped'：exact 基础上按 clip_sigma·std 剔除离群像素（鲁棒、确定性）；
+                   需逐像素扫描每格中心区域，每格 O(像素数)，并非 O(1)
+    """
+    mode = cfg.cell_stats
+    if mode not in ("sample", "exact", "clipped"):
+        raise ValueError(f"Unknown cell_stats: {mode}")
+    box = shrink_quad(mapped_box, cfg.card_crop_long, cfg.card_crop_short)
+    rects = _cell_rects(box, cfg)
+    rows, cols = cfg.grid_rows, cfg.grid_cols
+
+    means = np.zeros((3, rows, cols), dtype=np.float32)
+    variances = np.zeros((3, rows, cols), dtype=np.float32)
+    if mode in ("exact", "clipped"):
+        m_all, v_all = _integral_stats(image_bgr, [cr for *_, cr in rects])
+
+    for i, (r, c, (x1, y1, x2, y2), (cx1, cy1, cx2, cy2)) in enumerate(rects):
+        checkpoint(cancel, "extract")
+        if mode == "sample":
             patch = image_bgr[cy1:cy2, cx1:cx2]
             sel = _robust_center_pixels(patch, cfg.sample_count)  # (N,3) BGR
-            rgb = sel[:, ::-1]  # 转 RGB
-            mean_rgb = rgb.mean(axis=0)
-            means[:, r, c] = mean_rgb
+            m, v = sel.mean(axis=0), sel.var(axis=0)
+        elif mode == "exact":
+            m, v = m_all[i], v_all[i]
+        else:
+            m, v = _clipped_stats(image_bgr[cy1:cy2, cx1:cx2], m_all[i], v_all[i], cfg.clip_sigma)
+        means[:, r, c] = m[::-1]      # 转 RGB
+        variances[:, r, c] = v[::-1]
 
-            if draw_grid:
-                cv2.rectangle(image_bgr, (x1, y1), (x2, y2), (0,0,255), 1)      # 小格外框
-                cv2.rectangle(image_bgr, (cx1, cy1), (cx2, cy2), (0,255,255), 2) # 实际采样区域（黄）
+        if draw_grid:
+            cv2.rectangle(image_bgr, (x1, y1), (x2, y2), (0,0,255), 1)      # 小格外框
+            cv2.rectangle(image_bgr, (cx1, cy1), (cx2, cy2), (0,255,255), 2) # 实际采样区域（黄）
 
+    return means, variances
+
+def extract_card_means(image_bgr, mapped_box, cfg: PipelineConfig, draw_grid=True):
+    """
+    在原始图像中对 4×6 网格取“中心 area% 面积”，做鲁棒均值，输出 (3,4,6)
+    """
+    means, _ = extract_card_stats(image_bgr, mapped_box, cfg, draw_grid=draw_grid)
     return means  # (3,4,6)
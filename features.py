@@ -15,7 +15,8 @@ def build_features(ref_346, sam_346, mode="log_ratio",
       per_image_channel_norm: 是否做每图每通道标准化（对 log_ratio/ratio 有利）
     返回:
       X: 特征张量（'log_ratio'/'ratio' => (3,4,6); 'multi' => (15,4,6)）
-      extras: dict，包含 ref_lin/sam_lin/ratio/log_ratio 便于保存与可视化
+      extras: dict，包含 ref_lin/sam_lin/ratio/log_ratio 便于保存与可视化，
+              以及未做每图标准化的 X_raw（用于数据集级统计/标准化）
     """
     ref = ref_346.astype(np.float32) / 255.0
     sam = sam_346.astype(np.float32) / 255.0
@@ -29,15 +30,18 @@ def build_features(ref_346, sam_346, mode="log_ratio",
 
     if mode == "log_ratio":
         X = log_ratio.copy()
+        X_raw = X.copy()
         if per_image_channel_norm:
             X = (X - X.mean(axis=(1,2), keepdims=True)) / (X.std(axis=(1,2), keepdims=True) + eps)
     elif mode == "ratio":
         X = ratio.copy()
+        X_raw = X.copy()
         if per_image_channel_norm:
             X = X / (X.mean(axis=(1,2), keepdims=True) + eps)
     elif mode == "multi":
         # 按 [ref_lin, sam_lin, ratio, log_ratio, delta] 维度拼接（3*5=15 通道）
         X = np.concatenate([ref_lin, sam_lin, ratio, log_ratio, delta], axis=0)
+        X_raw = X
         # multi 通常不做通道内标准化，保留原始比例
     else:
         raise ValueError(f"Unknown feature_mode: {mode}")
@@ -46,6 +50,7 @@ def build_features(ref_346, sam_346, mode="log_ratio",
         "ref_lin": ref_lin,
         "sam_lin": sam_lin,
         "ratio": ratio,
-        "log_ratio": log_ratio
+        "log_ratio": log_ratio,
+        "X_raw": X_raw.astype(np.float32),
     }
     return X.astype(np.float32), extras
@@ -18,3 +18,14 @@ def out_path(input_dir, output_dir, image_path, prefix="rgb_", suffix="", ext="n
     name = os.path.splitext(os.path.basename(image_path))[0]
     if suffix: suffix = "_" + suffix
     return os.path.join(folder, f"{prefix}{name}{suffix}.{ext}")
+
+def append_csv_row(path, row: dict):
+    """追加一行到 CSV；文件不存在时先写表头"""
+    import csv
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    new = not os.path.exists(path)
+    with open(path, "a", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=list(row.keys()))
+        if new:
+            w.writeheader()
+        w.writerow(row)
@@ -1,26 +1,52 @@
 # colorcard_kit/manual_select.py
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
 import cv2
 import numpy as np
 
+from budget import BudgetExceeded, CancelToken, checkpoint
+
 class TwoRectSelector:
     def __init__(self, image_bgr, window_name="Select Ref (Top) then Sample (Bottom)"):
         self.img = image_bgr
-        self.clone = image_bgr.copy()
+        self.clone = image_bgr.copy()   # 已确认的框
+        self.canvas = self.clone.copy() # 实际显示：clone + 正在拖动的框
         self.win = window_name
         self.rects = []  # [(x0,y0,x1,y1), ...]
         self.drawing = False
         self.x0 = self.y0 = 0
+        self._drag = None  # 上一帧拖动框
+
+    def _restore_outline(self, rect, t=2):
+        """只把上一帧矩形边框所在的四条细带从 clone 拷回 canvas（而不是整图复制）"""
+        h, w = self.canvas.shape[:2]
+        x0, y0, x1, y1 = rect
+        xa, xb = max(min(x0, x1) - t, 0), min(max(x0, x1) + t + 1, w)
+        ya, yb = max(min(y0, y1) - t, 0), min(max(y0, y1) + t + 1, h)
+        for ys, xs in ((slice(ya, min(ya + 2*t + 1, yb)), slice(xa, xb)),
+                       (slice(max(yb - 2*t - 1, ya), yb), slice(xa, xb)),
+                       (slice(ya, yb), slice(xa, min(xa + 2*t + 1, xb))),
+                       (slice(ya, yb), slice(max(xb - 2*t - 1, xa), xb))):
+            self.canvas[ys, xs] = self.clone[ys, xs]
 
     def _mouse(self, event, x, y, flags, param):
         if event == cv2.EVENT_LBUTTONDOWN:
             self.drawing = True
             self.x0, self.y0 = x, y
+            self._drag = None
         elif event == cv2.EVENT_MOUSEMOVE and self.drawing:
-            img2 = self.clone.copy()
-            cv2.rectangle(img2, (self.x0, self.y0), (x, y), (0, 255, 0) if len(self.rects)==0 else (255, 0, 0), 2)
-            cv2.imshow(self.win, img2)
+            if self._drag is not None:
+                self._restore_outline(self._drag)
+            self._drag = (self.x0, self.y0, x, y)
+            cv2.rectangle(self.canvas, (self.x0, self.y0), (x, y), (0, 255, 0) if len(self.rects)==0 else (255, 0, 0), 2)
+            cv2.imshow(self.win, self.canvas)
         elif event == cv2.EVENT_LBUTTONUP:
             self.drawing = False
+            if self._drag is not None:
+                self._restore_outline(self._drag)
+                self._drag = None
             x1, y1 = x, y
             x0, y0 = self.x0, self.y0
             x_min, y_min = min(x0, x1), min(y0, y1)
@@ -28,7 +54,8 @@ class TwoRectSelector:
             self.rects.append((x_min, y_min, x_max, y_max))
             color = (0, 255, 0) if len(self.rects)==1 else (255, 0, 0)
             cv2.rectangle(self.clone, (x_min, y_min), (x_max, y_max), color, 2)
-            cv2.imshow(self.win, self.clone)
+            cv2.rectangle(self.canvas, (x_min, y_min), (x_max, y_max), color, 2)
+            cv2.imshow(self.win, self.canvas)
 
     def run(self):
         cv2.namedWindow(self.win, cv2.WINDOW_NORMAL)
@@ -44,8 +71,9 @@ class TwoRectSelector:
                 return None, None
             elif key == ord('r'):
                 self.clone = self.img.copy()
+                self.canvas = self.clone.copy()
                 self.rects = []
-                cv2.imshow(self.win, self.clone)
+                cv2.imshow(self.win, self.canvas)
             elif key in (13, 10):  # Enter
                 if len(self.rects) >= 2:
                     break
@@ -60,18 +88,136 @@ class TwoRectSelector:
         return ref_box, sample_box
 
 
-def select_two_rects(image_bgr, max_side=1200):
+def make_preview(image_path, cfg, max_side, cancel=None):
+    """
+    生成手动标注用的预览图：JPEG/可分块 TIFF 走降采样解码，其余整图解码后缩放。
+    返回：(preview_bgr, (sx, sy))，sx/sy 为 预览/原图 的缩放比例
+    """
+    from detect import load_image, load_reduced, supports_roi_reads
+    from PIL import Image
+    if supports_roi_reads(image_path):
+        with Image.open(image_path) as im:
+            ow, oh = im.size
+        th = min(oh, int(max_side * oh / max(ow, oh)))
+        small, (ow, oh, nw, nh) = load_reduced(image_path, th, cancel=cancel)
+    else:
+        im = load_image(image_path, cfg)
+        checkpoint(cancel, "preview")
+        ow, oh = im.size
+        s = min(1.0, max_side / float(max(ow, oh)))
+        nw, nh = max(1, int(ow * s)), max(1, int(oh * s))
+        small = im.resize((nw, nh))
+        del im
+    bgr = cv2.cvtColor(np.array(small), cv2.COLOR_RGB2BGR)
+    return bgr, (nw / ow, nh / oh)
+
+def make_preview_job(image_path, cfg, max_side):
+    """供 budget.BudgetRunner 在子进程中调用：带 image_timeout_s 协作式超时生成预览"""
+    return make_preview(image_path, cfg, max_side, cancel=CancelToken(timeout_s=cfg.image_timeout_s))
+
+class PreviewCache:
+    """
+    后台生成手动标注预览图（按处理顺序的滑动窗口）：
+      - prefetch(paths)：按处理顺序登记可能需要手动标注的图，只提前生成最前面 capacity 张
+      - get(path)：已生成则直接返回；正在生成则最多等待 timeout 秒；未预取/失败/超时返回 None
+      - discard(path)：该图已处理完（无论是否用到预览），释放并补充窗口
+    未被消费的预览不会被淘汰，窗口随批处理进度向前推进。
+    设置了单图预算（image_timeout_s / image_mem_mb）时，预览在子进程中生成，
+    卡死或耗尽内存的文件只会让这一张超出预算（get 抛 BudgetExceeded），不影响本进程。
+    """
+    def __init__(self, cfg, max_side=None, workers=1, capacity=32, timeout=None):
+        self.cfg = cfg
+        self.max_side = max_side or cfg.manual_downscale
+        self.capacity = capacity
+        if timeout is None:
+            # 最坏情况：前一张仍在生成（硬超时）+ 本张生成
+            timeout = 2 * (cfg.image_timeout_s + 5.0) if cfg.image_timeout_s > 0 else 120.0
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # path -> Future（窗口内）
+        self._pending = deque()      # 尚未进入窗口的路径
+        self._local = threading.local()
+        self._runners = []
+
+    def prefetch(self, paths):
+        with self._lock:
+            queued = set(self._pending)
+            for p in paths:
+                if p not in self._items and p not in queued:
+                    self._pending.append(p)
+                    queued.add(p)
+            self._fill()
+
+    def _fill(self):
+        while self._pending and len(self._items) < self.capacity:
+            p = self._pending.popleft()
+            if p not in self._items:
+                self._items[p] = self._pool.submit(self._make, p)
+
+    def _make(self, path):
+        """后台线程中生成一张预览；有预算时每个线程使用自己的常驻子进程"""
+        runner = getattr(self._local, "runner", None)
+        if runner is None and (self.cfg.image_timeout_s > 0 or self.cfg.image_mem_mb > 0):
+            from pipeline import make_runner
+            runner = self._local.runner = make_runner(self.cfg)
+            with self._lock:
+                self._runners.append(runner)
+        if runner is None:
+            return make_preview(path, self.cfg, self.max_side)
+        return runner.run(make_preview_job, path, self.cfg, self.max_side)
+
+    def get(self, path, timeout=None):
+        with self._lock:
+            fut = self._items.get(path)
+        if fut is None:
+            return None
+        try:
+            return fut.result(timeout=self.timeout if timeout is None else timeout)
+        except BudgetExceeded:
+            raise
+        except FutureTimeout:
+            print(f"[Preview] timed out after {self.timeout:g}s: {path}")
+        except Exception as e:
+            print(f"[Preview] {e}")
+        return None
+
+    def discard(self, path):
+        with self._lock:
+            fut = self._items.pop(path, None)
+            if fut is None:
+                try:
+                    self._pending.remove(path)
+                except ValueError:
+                    pass
+            else:
+                fut.cancel()
+            self._fill()
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            runners, self._runners = self._runners, []
+        for r in runners:
+            r.close()
+
+def select_two_rects(image_bgr, max_side=1200, preview=None):
     """
     入口：给定 BGR 图，缩放显示后让用户依次框选两块区域（上：Ref，下：Sample）
+    preview=(disp_bgr, (sx, sy)) 时直接使用已缓存的预览图（image_bgr 可为 None）
     返回：ref_box(4x2), sample_box(4x2)（坐标在原图尺度）
     """
-    h, w = image_bgr.shape[:2]
-    scale = 1.0
-    if max(h, w) > max_side:
-        scale = max_side / float(max(h, w))
-        disp = cv2.resize(image_bgr, (int(w*scale), int(h*scale)))
+    if preview is not None:
+        disp, (sx, sy) = preview
+        disp = disp.copy()
     else:
-        disp = image_bgr.copy()
+        h, w = image_bgr.shape[:2]
+        sx = sy = 1.0
+        if max(h, w) > max_side:
+            sx = sy = max_side / float(max(h, w))
+            disp = cv2.resize(image_bgr, (int(w*sx), int(h*sy)))
+        else:
+            disp = image_bgr.copy()
 
     selector = TwoRectSelector(disp, "Select Ref (Top) then Sample (Bottom)  [Enter:OK / r:reset / Esc:cancel]")
     ref_box_s, sample_box_s = selector.run()
@@ -79,9 +225,10 @@ def select_two_rects(image_bgr, max_side=1200):
         return None, None
 
     # 映射回原图坐标
-    if scale != 1.0:
-        ref_box = (ref_box_s.astype(np.float32) / scale).round().astype(int)
-        sample_box = (sample_box_s.astype(np.float32) / scale).round().astype(int)
+    if (sx, sy) != (1.0, 1.0):
+        inv = np.array([1.0 / sx, 1.0 / sy], dtype=np.float32)
+        ref_box = (ref_box_s.astype(np.float32) * inv).round().astype(int)
+        sample_box = (sample_box_s.astype(np.float32) * inv).round().astype(int)
     else:
         ref_box, sample_box = ref_box_s, sample_box_s
     return ref_box, sample_box
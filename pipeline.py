@@ -1,69 +1,254 @@
 # colorcard_kit/pipeline.py
 import os
 import numpy as np
-import cv2
-from PIL import Image
 
 from config import PipelineConfig
-from detect import load_image, resize_keep_h, detect_regions_pair
-from extract import extract_card_means
 from features import build_features
-from visualize import visualize_pair
-from io_utils import out_path
-from manual_select import select_two_rects
+from io_utils import out_path, append_csv_row
+from budget import checkpoint, CancelToken
 
-def process_single(image_path, input_dir, output_dir, cfg: PipelineConfig):
+# OpenCV / PIL / matplotlib 等重依赖由各阶段在 process_single 内按需导入，
+# 使 `import pipeline`（以及只需要特征的批处理/子进程）启动更快。
+
+DETECT_LOG = "detect_log.csv"
+
+def _record_detect(output_dir, image_path, info):
+    """每张图的检测结果（采用级别/置信度/各级耗时）追加到 detect_log.csv"""
+    stages = ";".join(f"{n}:{c:.3f}/{ms:.1f}ms" for n, c, ms in info["stages"])
+    append_csv_row(os.path.join(output_dir, DETECT_LOG), {
+        "image": image_path,
+        "level": info["level"],
+        "confidence": f"{info['confidence']:.4f}",
+        "detect_ms": f"{sum(ms for _, _, ms in info['stages']):.1f}",
+        "stages": stages,
+    })
+
+def summarize_detect_log(output_dir):
     """
-    流程：
+    汇总 detect_log.csv：各级别采用次数、每级平均耗时、手动回退与跳过数量
+    （同一图像有多行时，如子进程自动检测失败后再手动，级别以最后一行为准）
+    返回 dict：{"levels": {level: n}, "stage_ms": {stage: 平均ms}, "manual": n, "skip": n, "total": n}
+    """
+    import csv
+    path = os.path.join(output_dir, DETECT_LOG)
+    final, stage_ms = {}, {}
+    if os.path.exists(path):
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                final[row["image"]] = row["level"]
+                for item in filter(None, row["stages"].split(";")):
+                    name, _, rest = item.partition(":")
+                    stage_ms.setdefault(name, []).append(float(rest.split("/")[1][:-2]))
+    levels = {}
+    for level in final.values():
+        levels[level] = levels.get(level, 0) + 1
+    return {
+        "levels": levels,
+        "stage_ms": {k: float(np.mean(v)) for k, v in stage_ms.items()},
+        "manual": levels.get("manual", 0),
+        "skip": levels.get("skip", 0),
+        "total": sum(levels.values()),
+    }
+
+def _extract_from_rois(image_path, boxes, full_size, cfg: PipelineConfig, preview=None, cancel=None):
+    """
+    只读取两块色卡所在的全分辨率区域做提取（不解码/不保留整幅 BGR 图）；
+    preview（已解码的检测尺度 RGB PIL 图）非空时在其上合成标注图，否则不生成标注图。
+    返回：[(rgb_346, var_346), ...], ann
+    """
+    import cv2
+    from detect import read_regions
+    from extract import extract_card_stats
+
+    ow, oh = full_size
+    pad = 8  # 留出标注线宽
+    rects = []
+    for b in boxes:
+        x1, y1 = np.maximum(b.min(axis=0) - pad, 0)
+        x2, y2 = np.minimum(b.max(axis=0) + pad, (ow, oh))
+        rects.append((int(x1), int(y1), int(x2), int(y2)))
+    crops = read_regions(image_path, rects, cfg, cancel=cancel)
+
+    annotate = preview is not None
+    ann = s = None
+    if annotate:
+        ann = cv2.cvtColor(np.array(preview), cv2.COLOR_RGB2BGR)
+        s = ann.shape[0] / oh
+
+    stats = []
+    for b, (x1, y1, x2, y2), crop, color in zip(boxes, rects, crops, [(0, 255, 0), (255, 0, 0)]):
+        crop_bgr = cv2.cvtColor(crop, cv2.COLOR_RGB2BGR)
+        local = b - np.array([x1, y1])
+        if annotate:
+            cv2.polylines(crop_bgr, [local], True, color, 4)
+        stats.append(extract_card_stats(crop_bgr, local, cfg, draw_grid=annotate, cancel=cancel))
+        if annotate:
+            # 把画好网格的 ROI 缩小后贴回预览图
+            px1, py1 = int(x1 * s), int(y1 * s)
+            px2, py2 = min(int(x2 * s), ann.shape[1]), min(int(y2 * s), ann.shape[0])
+            if px2 > px1 and py2 > py1:
+                ann[py1:py2, px1:px2] = cv2.resize(crop_bgr, (px2 - px1, py2 - py1),
+                                                   interpolation=cv2.INTER_AREA)
+    return stats, ann
+
+def _select_manual(image_path, cfg: PipelineConfig, render, preview_cache=None, im_bgr=None):
+    """
+    手动框选，尽量不做整图解码：预取的预览图 → 已解码的整图 → render()（现场生成降采样预览）。
+    返回 (ref_box, sample_box)（原图坐标）；操作员取消时返回 None
+    """
+    from manual_select import select_two_rects
+    preview = preview_cache.get(image_path) if preview_cache is not None else None
+    if preview is None and im_bgr is None:
+        preview = render()
+    if preview_cache is not None:
+        preview_cache.discard(image_path)
+    ref_box, sample_box = select_two_rects(im_bgr, max_side=cfg.manual_downscale, preview=preview)
+    if ref_box is None or sample_box is None:
+        return None
+    return ref_box, sample_box
+
+def run_stages(image_path, cfg: PipelineConfig, annotate=True, preview_cache=None, cancel=None, boxes=None):
+    """
+    process_single 的 1~3 步，不写任何文件：
       1) 读取（支持 CR2 线性 postprocess）并缩放
-      2) 自动检测上下两块；若失败并允许手动/或强制手动 → 交互框选
+      2) 级联自动检测上下两块；若失败并允许手动/或强制手动 → 交互框选
       3) 提取 (3,4,6)，构建特征（log_ratio/ratio/multi）
-      4) 保存 npy 与可视化
+    boxes=(ref_box, sample_box)（原图坐标，如操作员在别的进程里框选的结果）给出时跳过检测，直接提取。
+    annotate=False 时不生成标注图（服务/批量只要特征时更省内存）。
+    roi_reads=True 且为 JPEG/可分块 TIFF 时：检测图走草图/条带降采样解码，全分辨率只读两块色卡区域。
+    需要手动框选时（强制手动：解码前；自动失败：检测后）在预览图上框选，之后只按框选区域读取：
+    preview_cache（manual_select.PreviewCache）中有预取好的预览图就直接用，否则现场降采样生成。
+    cancel（budget.CancelToken）：各阶段内的取消检查点，停止或超时时抛 Cancelled / BudgetExceeded。
+    返回：(res, detect_info)；无法得到两块区域时 res 为 None
+      res = {"X", "X_raw", "ref_346", "sample_346", "ref_var_346", "sample_var_346",
+             "ratio_346", "log_ratio_346", "edges", "ann"}
     """
-    # 读取（自动 RAW → 线性）
-    im = load_image(image_path, cfg)  # PIL.Image RGB
-    resized, (ow, oh, nw, nh) = resize_keep_h(im, cfg.target_height)
-    scale_x, scale_y = ow / nw, oh / nh
+    import cv2
+    from detect import (load_image, load_reduced, supports_roi_reads, resize_keep_h,
+                        detect_regions_pair, detect_regions_cascade, score_pair)
+    from extract import extract_card_stats
+    from manual_select import make_preview
+
+    def render():
+        return make_preview(image_path, cfg, cfg.manual_downscale, cancel=cancel)
 
+    detect_info = {"level": None, "confidence": 0.0, "stages": []}
+    if boxes is None and cfg.force_manual:
+        # 强制手动：先框选再读取，选择窗口不等待检测用的解码
+        boxes = _select_manual(image_path, cfg, render, preview_cache)
+        if boxes is None:
+            detect_info["level"] = "skip"
+            return None, detect_info
+
+    preview = None
+    if cfg.roi_reads and supports_roi_reads(image_path):
+        # 仅解码检测所需的小图（标注图也在它上面合成，不再额外解码）；
+        # 全分辨率整图按需（手动回退）才读取
+        resized, (ow, oh, nw, nh) = load_reduced(image_path, cfg.target_height, cancel=cancel)
+        preview = resized if annotate else None
+        im_bgr = None
+    else:
+        # 读取（自动 RAW → 线性）
+        im = load_image(image_path, cfg)  # PIL.Image RGB
+        checkpoint(cancel, "load")
+        resized, (ow, oh, nw, nh) = resize_keep_h(im, cfg.target_height)
+        im_bgr = cv2.cvtColor(np.array(im), cv2.COLOR_RGB2BGR)
+        del im
+    scale_x, scale_y = ow / nw, oh / nh
     im_gray = np.array(resized.convert("L"))
-    im_bgr = cv2.cvtColor(np.array(im), cv2.COLOR_RGB2BGR)
-    ann = im_bgr.copy()
 
     # —— 自动检测（除非强制手动）
     ref_box = sample_box = None
     edges = None
-    if not cfg.force_manual:
-        edges, ref_box_s, sample_box_s = detect_regions_pair(im_gray, cfg)
+    if boxes is not None:
+        ref_box, sample_box = (np.asarray(b) for b in boxes)
+        detect_info["level"] = "manual"
+    else:
+        if cfg.detect_cascade:
+            edges, ref_box_s, sample_box_s, detect_info = detect_regions_cascade(im_gray, cfg, cancel=cancel)
+        else:
+            edges, ref_box_s, sample_box_s = detect_regions_pair(im_gray, cfg)
+            conf = score_pair(ref_box_s, sample_box_s, im_gray.shape)
+            detect_info = {"level": "default" if ref_box_s is not None else None,
+                           "confidence": conf, "stages": [("default", conf, 0.0)]}
         if ref_box_s is not None and sample_box_s is not None:
             ref_box = np.array([[int(x*scale_x), int(y*scale_y)] for x, y in ref_box_s])
             sample_box = np.array([[int(x*scale_x), int(y*scale_y)] for x, y in sample_box_s])
 
-    # —— 手动回退（或强制手动）
+    # —— 手动回退（ROI 路径下用降采样预览，不做整图解码）
     if ref_box is None or sample_box is None:
-        if cfg.allow_manual or cfg.force_manual:
-            ref_box, sample_box = select_two_rects(im_bgr, max_side=cfg.manual_downscale)
+        if cfg.allow_manual:
+            boxes = _select_manual(image_path, cfg, render, preview_cache, im_bgr=im_bgr)
+            if boxes is not None:
+                ref_box, sample_box = boxes
+            detect_info["level"] = "manual"
         if ref_box is None or sample_box is None:
-            print(f"[Skip] Unable to get two regions (auto/manual): {image_path}")
-            return None
-        # 手动模式下 edges 为空，用 None 占位
-        edges = edges if edges is not None else None
+            detect_info["level"] = "skip"
+            return None, detect_info
 
-    # 标注区域框
-    cv2.polylines(ann, [ref_box], True, (0, 255, 0), 4)     # 上方（绿）
-    cv2.polylines(ann, [sample_box], True, (255, 0, 0), 4)  # 下方（蓝）
+    checkpoint(cancel, "detect")
+    if im_bgr is None:
+        ((ref_rgb_346, ref_var_346), (sample_rgb_346, sample_var_346)), ann = \
+            _extract_from_rois(image_path, [ref_box, sample_box], (ow, oh), cfg, preview=preview, cancel=cancel)
+    else:
+        ann = im_bgr.copy() if annotate else None
+        if annotate:
+            # 标注区域框
+            cv2.polylines(ann, [ref_box], True, (0, 255, 0), 4)     # 上方（绿）
+            cv2.polylines(ann, [sample_box], True, (255, 0, 0), 4)  # 下方（蓝）
 
-    # 提取 (3,4,6)；在 ann 上画红格与黄中心框
-    ref_rgb_346    = extract_card_means(ann, ref_box, cfg, draw_grid=True)
-    sample_rgb_346 = extract_card_means(ann, sample_box, cfg, draw_grid=True)
+        # 提取 (3,4,6)；在 ann 上画红格与黄中心框
+        src = ann if annotate else im_bgr
+        ref_rgb_346, ref_var_346       = extract_card_stats(src, ref_box, cfg, draw_grid=annotate, cancel=cancel)
+        sample_rgb_346, sample_var_346 = extract_card_stats(src, sample_box, cfg, draw_grid=annotate, cancel=cancel)
 
     # 构建特征
     X, extras = build_features(
         ref_rgb_346, sample_rgb_346,
         mode=cfg.feature_mode,
-        per_image_channel_norm=cfg.per_image_channel_norm
+        per_image_channel_norm=cfg.per_image_channel_norm and not cfg.dataset_norm
     )
-    ratio_346 = extras["ratio"]
-    log_ratio_346 = extras["log_ratio"]
+    if cfg.dataset_norm:
+        from dataset_stats import load_cached, apply_dataset_norm
+        X = apply_dataset_norm(extras["X_raw"], load_cached(cfg.dataset_stats_path), level=cfg.dataset_norm,
+                               feature_mode=cfg.feature_mode)
+    return {
+        "X": X,
+        "X_raw": extras["X_raw"],
+        "ref_346": ref_rgb_346,
+        "sample_346": sample_rgb_346,
+        "ref_var_346": ref_var_346,
+        "sample_var_346": sample_var_346,
+        "ratio_346": extras["ratio"],
+        "log_ratio_346": extras["log_ratio"],
+        "edges": edges,
+        "ann": ann,
+    }, detect_info
+
+def process_single(image_path, input_dir, output_dir, cfg: PipelineConfig, preview_cache=None, stats=None,
+                   cancel=None, boxes=None):
+    """
+    流程：
+      1~3) run_stages：读取、级联检测（含手动回退）、提取与构建特征；
+           检测级别与置信度记录到 detect_log.csv
+      4) 保存 npy 与可视化
+    stats（dataset_stats.DatasetStats）非空时，顺带在线累积 features_raw / ref_346 / sample_346 的数据集统计。
+    boxes：已框选好的两块区域（见 run_stages）。
+    """
+    res, detect_info = run_stages(image_path, cfg, annotate=cfg.save_vis, preview_cache=preview_cache,
+                                  cancel=cancel, boxes=boxes)
+    _record_detect(output_dir, image_path, detect_info)
+    if res is None:
+        print(f"[Skip] Unable to get two regions (auto/manual): {image_path}")
+        return None
+
+    X = res["X"]
+    if stats is not None:
+        stats.update("features_raw", res["X_raw"])
+        stats.update("ref_346", res["ref_346"])
+        stats.update("sample_346", res["sample_346"])
+    ref_rgb_346, sample_rgb_346 = res["ref_346"], res["sample_346"]
+    ratio_346, log_ratio_346 = res["ratio_346"], res["log_ratio_346"]
 
     # 保存 npy
     feat_tag = cfg.feature_mode
@@ -75,30 +260,108 @@ def process_single(image_path, input_dir, output_dir, cfg: PipelineConfig):
     np.save(ref_path,     ref_rgb_346.astype(np.float32))
     np.save(sample_path,  sample_rgb_346.astype(np.float32))
 
+    # 每格方差（质量控制）
+    ref_var_path    = out_path(input_dir, output_dir, image_path, prefix="refvar_",    suffix="346", ext="npy")
+    sample_var_path = out_path(input_dir, output_dir, image_path, prefix="samplevar_", suffix="346", ext="npy")
+    np.save(ref_var_path,    res["ref_var_346"].astype(np.float32))
+    np.save(sample_var_path, res["sample_var_346"].astype(np.float32))
+
     if cfg.save_extras:
         ratio_path = out_path(input_dir, output_dir, image_path, prefix="ratio_",     suffix="346", ext="npy")
         lgrt_path  = out_path(input_dir, output_dir, image_path, prefix="logratio_",  suffix="346", ext="npy")
         np.save(ratio_path, ratio_346.astype(np.float32))
         np.save(lgrt_path,  log_ratio_346.astype(np.float32))
 
-    # 可视化
-    vis_dir = os.path.join(output_dir, "vis")
-    os.makedirs(vis_dir, exist_ok=True)
-    vis_path = visualize_pair(
-        image_path,
-        edges=edges,
-        annotated_bgr=ann,
-        ref_rgb_346=ref_rgb_346,
-        sample_rgb_346=sample_rgb_346,
-        ratio_346=ratio_346,
-        log_ratio_346=log_ratio_346,
-        feature_mode=cfg.feature_mode,
-        out_dir=vis_dir
-    )
+    # 可视化（save_vis=False 时完全不导入 matplotlib）
+    vis_path = None
+    checkpoint(cancel, "save")
+    if cfg.save_vis:
+        from visualize import visualize_pair
+        vis_dir = os.path.join(output_dir, "vis")
+        os.makedirs(vis_dir, exist_ok=True)
+        vis_path = visualize_pair(
+            image_path,
+            edges=res["edges"],
+            annotated_bgr=res["ann"],
+            ref_rgb_346=ref_rgb_346,
+            sample_rgb_346=sample_rgb_346,
+            ratio_346=ratio_346,
+            log_ratio_346=log_ratio_346,
+            feature_mode=cfg.feature_mode,
+            out_dir=vis_dir
+        )
 
     return {
         "features": feat_path,
         "ref_346": ref_path,
         "sample_346": sample_path,
-        "vis": vis_path
+        "ref_var_346": ref_var_path,
+        "sample_var_346": sample_var_path,
+        "vis": vis_path,
+        "detect_level": detect_info["level"],
+        "confidence": detect_info["confidence"],
     }
+
+def process_single_job(image_path, input_dir, output_dir, cfg: PipelineConfig, boxes=None):
+    """
+    供 budget.BudgetRunner 在子进程中调用：带 image_timeout_s 协作式超时运行 process_single，
+    并把该图的数据集统计作为可合并的 DatasetStats 一并返回。
+    """
+    from dataset_stats import DatasetStats
+    part = DatasetStats(cfg.feature_mode)
+    res = process_single(image_path, input_dir, output_dir, cfg, stats=part,
+                         cancel=CancelToken(timeout_s=cfg.image_timeout_s), boxes=boxes)
+    return res, part
+
+def make_runner(cfg: PipelineConfig, stop_event=None):
+    """
+    按 image_timeout_s / image_mem_mb 构造子进程执行器；两者都为 0 时返回 None（本进程执行）。
+    硬超时比协作式超时多留 5s，正常情况下由阶段内检查点先行结束。
+    """
+    from budget import BudgetRunner
+    if cfg.image_timeout_s <= 0 and cfg.image_mem_mb <= 0:
+        return None
+    hard = cfg.image_timeout_s + 5.0 if cfg.image_timeout_s > 0 else 0
+    return BudgetRunner(timeout_s=hard, mem_mb=cfg.image_mem_mb, stop_event=stop_event)
+
+def process_with_budget(image_path, input_dir, output_dir, cfg: PipelineConfig, runner=None,
+                        preview_cache=None, stats=None, stop_event=None):
+    """
+    批处理的执行入口。解码、检测、提取（含手动框选用的预览图）都在 runner 的子进程中
+    带时间/内存预算执行，本进程只做交互框选（操作员时间不计入预算）：
+      1) 自动检测（强制手动时跳过）；成功即返回
+      2) 需要手动时：取预览图（preview_cache 预取的，或在子进程中生成）→ 本进程框选
+      3) 框选结果交回子进程，按给定区域读取并提取
+    runner 为空（未设置预算）时同样的流程在本进程执行，仅做协作式停止检查。
+    超出预算抛 budget.BudgetExceeded，停止抛 budget.Cancelled，由调用方处理（隔离/中断）。
+    """
+    from dataclasses import replace
+    job_cfg = replace(cfg, allow_manual=False, force_manual=False)
+
+    def run(boxes=None):
+        if runner is None:
+            return process_single(image_path, input_dir, output_dir, job_cfg, stats=stats, boxes=boxes,
+                                  cancel=CancelToken(stop_event, cfg.image_timeout_s))
+        res, part = runner.run(process_single_job, image_path, input_dir, output_dir, job_cfg, boxes)
+        if stats is not None:
+            stats.merge(part)
+        return res
+
+    if not cfg.force_manual:
+        res = run()
+        if res is not None or not cfg.allow_manual:
+            return res
+
+    from manual_select import make_preview, make_preview_job
+
+    def render():
+        if runner is None:
+            return make_preview(image_path, cfg, cfg.manual_downscale, cancel=CancelToken(stop_event))
+        return runner.run(make_preview_job, image_path, cfg, cfg.manual_downscale)
+
+    boxes = _select_manual(image_path, cfg, render, preview_cache)
+    if boxes is None:
+        _record_detect(output_dir, image_path, {"level": "skip", "confidence": 0.0, "stages": []})
+        print(f"[Skip] Manual selection cancelled: {image_path}")
+        return None
+    return run(boxes=boxes)
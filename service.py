@@ -0,0 +1,437 @@
+# colorcard_kit/service.py
+"""
+本地特征提取服务：常驻进程池（预载 PipelineConfig 与 OpenCV 等依赖），
+按需对单张图返回特征数组。
+
+  POST /features
+    - Content-Type: application/json
+        {"path": "...", "output_dir": "...(可选，给出则同时写 npy)", "input_dir": "...", "save_vis": false}
+    - 其它 Content-Type：请求体即图像字节，扩展名由 ?ext=jpg 指定（RAW 需正确扩展名）
+  GET /metrics   延迟与批处理统计
+  GET /health
+
+仅监听本机地址；自动检测失败时不会弹出手动框选窗口。
+预算与批处理一致：每张图有协作式超时（image_timeout_s）与子进程内存上限（image_mem_mb）；
+某批超出硬超时（每张 image_timeout_s + 5s）时结束整个进程池并重建，同时在途的其它批重新排队一次。
+"""
+import os
+import json
+import time
+import queue
+import argparse
+import tempfile
+import itertools
+import threading
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from config import PipelineConfig
+from budget import CancelToken, BudgetExceeded, is_out_of_memory, limit_memory
+
+# —— 工作进程侧
+_WORKER_CFG = None
+_STARTED = None  # 批开始执行时回报 (batch_id, time.monotonic())，供硬超时计时
+
+def _worker_init(cfg: PipelineConfig, started=None):
+    """进程池初始化：固定配置并预先导入各阶段依赖（warm worker）"""
+    global _WORKER_CFG, _STARTED
+    _WORKER_CFG = replace(cfg, allow_manual=False, force_manual=False)
+    _STARTED = started
+    import cv2  # noqa: F401
+    import detect, extract  # noqa: F401
+    if cfg.image_mem_mb > 0:
+        limit_memory(cfg.image_mem_mb)
+
+def _array(a):
+    return None if a is None else {"shape": list(a.shape), "data": np.asarray(a, dtype=np.float32).tolist()}
+
+def _run_one(item):
+    """item: {"path" 或 "data"+"ext", 可选 "output_dir"/"input_dir"/"save_vis"}"""
+    from pipeline import run_stages, process_single
+    tmp = None
+    try:
+        path = item.get("path")
+        if path is None:
+            fd, tmp = tempfile.mkstemp(suffix="." + item.get("ext", "jpg").lstrip("."))
+            with os.fdopen(fd, "wb") as f:
+                f.write(item["data"])
+            path = tmp
+        if not os.path.isfile(path):
+            return {"ok": False, "error": f"file not found: {path}"}
+
+        cfg = _WORKER_CFG
+        cancel = CancelToken(timeout_s=cfg.image_timeout_s)
+        if item.get("output_dir"):
+            # 同时写出文件（与批处理相同的目录结构），数组从刚写出的 npy 读回
+            cfg = replace(cfg, save_vis=bool(item.get("save_vis", False)))
+            files = process_single(path, item.get("input_dir") or os.path.dirname(path),
+                                   item["output_dir"], cfg, cancel=cancel)
+            if files is None:
+                return {"ok": False, "error": "unable to detect two regions"}
+            return {
+                "ok": True,
+                "features": _array(np.load(files["features"])),
+                "ref_346": _array(np.load(files["ref_346"])),
+                "sample_346": _array(np.load(files["sample_346"])),
+                "ref_var_346": _array(np.load(files["ref_var_346"])),
+                "sample_var_346": _array(np.load(files["sample_var_346"])),
+                "files": {k: files[k] for k in ("features", "ref_346", "sample_346",
+                                                "ref_var_346", "sample_var_346", "vis")},
+                "detect_level": files["detect_level"],
+                "confidence": files["confidence"],
+            }
+        res, info = run_stages(path, cfg, annotate=False, cancel=cancel)
+        if res is None:
+            return {"ok": False, "error": "unable to detect two regions",
+                    "detect_level": info["level"], "confidence": info["confidence"]}
+        return {
+            "ok": True,
+            "features": _array(res["X"]),
+            "ref_346": _array(res["ref_346"]),
+            "sample_346": _array(res["sample_346"]),
+            "ref_var_346": _array(res["ref_var_346"]),
+            "sample_var_346": _array(res["sample_var_346"]),
+            "ratio_346": _array(res["ratio_346"]),
+            "log_ratio_346": _array(res["log_ratio_346"]),
+            "detect_level": info["level"],
+            "confidence": info["confidence"],
+        }
+    except BudgetExceeded as e:
+        return {"ok": False, "error": f"budget exceeded: {e.reason}"}
+    except Exception as e:
+        if isinstance(e, MemoryError) or (_WORKER_CFG.image_mem_mb > 0 and is_out_of_memory(e)):
+            return {"ok": False, "error": f"budget exceeded: memory budget {_WORKER_CFG.image_mem_mb}MB "
+                                          f"({type(e).__name__}: {e})"}
+        return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    finally:
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+def _run_batch(items, batch_id=None):
+    if batch_id is not None and _STARTED is not None:
+        _STARTED.put((batch_id, time.monotonic()))
+    return [_run_one(it) for it in items]
+
+# —— 服务侧
+class _Metrics:
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.requests = self.errors = self.rejected = 0
+        self.batches = self.batched_items = 0
+
+    def record(self, latency_s, ok):
+        with self._lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.latencies.append(latency_s)
+
+    def record_batch(self, n):
+        with self._lock:
+            self.batches += 1
+            self.batched_items += n
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            lat = np.array(self.latencies, dtype=np.float64) * 1000.0
+            out = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_items / self.batches if self.batches else 0.0,
+            }
+        if lat.size:
+            out.update({
+                "latency_ms_mean": float(lat.mean()),
+                "latency_ms_p50": float(np.percentile(lat, 50)),
+                "latency_ms_p95": float(np.percentile(lat, 95)),
+                "latency_ms_p99": float(np.percentile(lat, 99)),
+            })
+        return out
+
+class FeatureService:
+    """
+    warm 进程池 + 请求批处理 + 并发上限。
+      workers:        工作进程数
+      max_pending:    同时在途的请求上限，超出直接返回 503
+      batch_size:     单批最多合并的请求数
+      batch_wait_ms:  凑批最多等待时间
+    """
+    def __init__(self, cfg: PipelineConfig, host="127.0.0.1", port=8765, workers=2,
+                 max_pending=16, batch_size=4, batch_wait_ms=5):
+        self.cfg = cfg
+        self.workers = workers
+        self.batch_size = max(1, int(batch_size))
+        self.batch_wait = max(0.0, batch_wait_ms / 1000.0)
+        self.metrics = _Metrics()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._queue = queue.Queue()
+        self._pool = None
+        self._stop = threading.Event()
+        # 硬超时：每张图在协作式超时之外再留 5s；0 = 不限
+        self._hard_s = cfg.image_timeout_s + 5.0 if cfg.image_timeout_s > 0 else 0
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}      # batch_id -> [进程池 Future, 张数, 截止时间（worker 开始执行后才有）]
+        self._batch_ids = itertools.count()
+        self._started = None     # worker → 服务的开始执行通知（每个进程池一个）
+        self._expired = set()    # 超出硬超时、已被强制结束的批
+        self._retried = set()    # 因进程池被结束而重新排队过的请求 Future
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._threads = []
+
+    @property
+    def address(self):
+        return self._httpd.server_address[:2]
+
+    def _new_pool(self):
+        # 每个进程池用新的通知队列：被强制结束的 worker 可能让旧队列处于不可用状态
+        self._started = mp.Queue() if self._hard_s else None
+        pool = ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=_worker_init, initargs=(self.cfg, self._started))
+        # 预热：确保每个进程都已完成导入
+        try:
+            for f in [pool.submit(_run_batch, []) for _ in range(self.workers)]:
+                f.result()
+        except Exception:
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        return pool
+
+    def _replace_pool(self):
+        """worker 崩溃（段错误 / 被系统杀掉）后进程池不可再用：丢弃并重建、重新预热"""
+        # 重建失败时保留旧池：其 submit 仍抛 BrokenProcessPool，下一批会再次尝试重建
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = self._new_pool()
+        print("[Service] process pool was broken; recreated")
+
+    def start(self):
+        self._pool = self._new_pool()
+        self._threads = [threading.Thread(target=self._batch_loop, daemon=True),
+                         threading.Thread(target=self._httpd.serve_forever, daemon=True)]
+        if self._hard_s:
+            self._threads.append(threading.Thread(target=self._watchdog, daemon=True))
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._queue.put(None)
+        for t in self._threads:
+            t.join(timeout=5)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def submit(self, item):
+        """
+        提交单个请求，返回 Future；在途请求已满时返回 None（调用方应回 503）
+        """
+        if not self._slots.acquire(blocking=False):
+            self.metrics.reject()
+            return None
+        fut = Future()
+        fut.add_done_callback(lambda _: self._slots.release())
+        self._queue.put((item, fut))
+        return fut
+
+    def _batch_loop(self):
+        while not self._stop.is_set():
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    self._stop.set()
+                    break
+                batch.append(nxt)
+            self._dispatch(batch)
+        # 退出时结束仍在排队的请求
+        while True:
+            try:
+                left = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if left is not None:
+                left[1].set_result({"ok": False, "error": "service stopped"})
+
+    def _dispatch(self, batch):
+        self.metrics.record_batch(len(batch))
+        items = [it for it, _ in batch]
+        bid = next(self._batch_ids) if self._hard_s else None
+        try:
+            try:
+                pf = self._pool.submit(_run_batch, items, bid)
+            except BrokenProcessPool:
+                self._replace_pool()
+                pf = self._pool.submit(_run_batch, items, bid)
+        except RuntimeError as e:  # 进程池已关闭 / 重建后仍不可用
+            for _, fut in batch:
+                fut.set_result({"ok": False, "error": str(e)})
+            return
+        if self._hard_s:
+            # 截止时间在 worker 真正开始执行时才确定，排队等待的时间不计入预算
+            with self._inflight_lock:
+                self._inflight[bid] = [pf, len(batch), None]
+
+        def done(pf):
+            with self._inflight_lock:
+                self._inflight.pop(bid, None)
+                expired = pf in self._expired
+                self._expired.discard(pf)
+            try:
+                results = pf.result()
+            except BrokenProcessPool as e:
+                if expired:
+                    results = [{"ok": False, "error": f"budget exceeded: hard timeout "
+                                                      f"{self._hard_s:g}s per image (workers killed)"}] * len(batch)
+                else:
+                    # 进程池被结束（其它批超时 / worker 崩溃）：未重试过的请求重新排队，下一次 _dispatch 时重建进程池
+                    results = []
+                    for it, fut in batch:
+                        if fut not in self._retried and not self._stop.is_set():
+                            self._retried.add(fut)
+                            fut.add_done_callback(self._retried.discard)
+                            self._queue.put((it, fut))
+                            results.append(None)
+                        else:
+                            results.append({"ok": False, "error": f"worker process died: {e}"})
+            except Exception as e:
+                results = [{"ok": False, "error": f"{type(e).__name__}: {e}"}] * len(batch)
+            for (_, fut), r in zip(batch, results):
+                if r is not None:
+                    fut.set_result(r)
+        pf.add_done_callback(done)
+
+    def _watchdog(self):
+        """硬超时兜底：阶段内检查点无法结束时（如卡在 C 扩展里），结束整个进程池"""
+        while not self._stop.wait(0.5):
+            started = self._started
+            with self._inflight_lock:
+                while started is not None:
+                    try:
+                        bid, t0 = started.get_nowait()
+                    except (queue.Empty, OSError, ValueError):
+                        break
+                    entry = self._inflight.get(bid)
+                    if entry is not None:
+                        entry[2] = t0 + self._hard_s * entry[1]
+                now = time.monotonic()
+                overdue = [pf for pf, _, deadline in self._inflight.values()
+                           if deadline is not None and now > deadline and pf not in self._expired]
+                self._expired.update(overdue)
+            if overdue:
+                pool = self._pool
+                # ProcessPoolExecutor 没有公开的结束 worker 接口（3.14 起才有 kill_workers）
+                for proc in list(getattr(pool, "_processes", {}).values()):
+                    proc.kill()
+                print(f"[Service] {len(overdue)} batch(es) exceeded the hard timeout; workers killed")
+
+    def _make_handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):  # 安静模式
+                pass
+
+            def _send(self, code, obj):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == "/metrics":
+                    self._send(200, service.metrics.snapshot())
+                elif path == "/health":
+                    self._send(200, {"ok": True})
+                else:
+                    self._send(404, {"ok": False, "error": "not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                if url.path != "/features":
+                    self._send(404, {"ok": False, "error": "not found"}); return
+                t0 = time.perf_counter()
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    try:
+                        item = json.loads(body.decode("utf-8"))
+                    except ValueError as e:
+                        self._send(400, {"ok": False, "error": f"bad json: {e}"}); return
+                    if "path" not in item:
+                        self._send(400, {"ok": False, "error": "missing 'path'"}); return
+                else:
+                    ext = parse_qs(url.query).get("ext", ["jpg"])[0]
+                    item = {"data": body, "ext": ext}
+
+                fut = service.submit(item)
+                if fut is None:
+                    self._send(503, {"ok": False, "error": "too many pending requests"}); return
+                res = fut.result()
+                service.metrics.record(time.perf_counter() - t0, res.get("ok", False))
+                self._send(200 if res.get("ok") else 422, res)
+
+        return Handler
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="本地色卡特征提取服务")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--max-pending", type=int, default=16)
+    ap.add_argument("--batch-size", type=int, default=4)
+    ap.add_argument("--batch-wait-ms", type=float, default=5)
+    ap.add_argument("--feature-mode", default="log_ratio", choices=["log_ratio", "ratio", "multi"])
+    args = ap.parse_args(argv)
+
+    cfg = PipelineConfig(feature_mode=args.feature_mode, allow_manual=False, save_vis=False)
+    svc = FeatureService(cfg, args.host, args.port, workers=args.workers,
+                         max_pending=args.max_pending, batch_size=args.batch_size,
+                         batch_wait_ms=args.batch_wait_ms).start()
+    host, port = svc.address
+    print(f"[Service] listening on http://{host}:{port}  workers={args.workers}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        svc.stop()
+
+if __name__ == "__main__":
+    main()
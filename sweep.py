@@ -0,0 +1,225 @@
+# colorcard_kit/sweep.py
+import os
+import csv
+import time
+import argparse
+import itertools
+import typing
+from dataclasses import fields, replace
+
+import numpy as np
+import cv2
+
+from config import PipelineConfig
+from detect import (load_image, load_reduced, supports_roi_reads, resize_keep_h,
+                    sobel_magnitude, detect_from_magnitude, detect_regions_cascade)
+from extract import extract_card_means
+from features import build_features
+from io_utils import find_images
+
+# 各阶段依赖的参数：只有这些参数变化时才需要重算该阶段
+DECODE_KEYS = ("target_height", "prefer_raw_linear", "raw_use_camera_wb", "raw_output_bps", "roi_reads")
+GRADIENT_KEYS = ("sobel_ksize",)
+DETECT_KEYS = ("edge_thresh", "detect_cascade", "cascade_min_confidence", "cascade_accept_confidence",
+               "cascade_close_ksize", "cascade_scales")
+EXTRACT_KEYS = ("card_crop_long", "card_crop_short", "sample_center_area",
+                "grid_rows", "grid_cols", "sample_count", "cell_stats", "clip_sigma")
+
+def _stage_key(cfg, keys):
+    return tuple(getattr(cfg, k) for k in keys)
+
+def expand_grid(base_cfg: PipelineConfig, grid):
+    """
+    grid: {参数名: [取值, ...]} → [(params, cfg), ...]（笛卡尔积）
+    """
+    names = {f.name for f in fields(PipelineConfig)}
+    unknown = [k for k in grid if k not in names]
+    if unknown:
+        raise ValueError(f"Unknown PipelineConfig field(s): {', '.join(unknown)}")
+    keys = list(grid.keys())
+    combos = []
+    for values in itertools.product(*(grid[k] for k in keys)):
+        params = dict(zip(keys, values))
+        combos.append((params, replace(base_cfg, **params)))
+    return combos
+
+def _decode(path, cfg: PipelineConfig):
+    """
+    读取一次：检测用灰度图 + 原图 BGR + 缩放比例。
+    检测图与批处理（run_stages）同源：roi_reads 且格式支持时用 load_reduced 的降采样解码，
+    否则整图缩放；提取用的全分辨率像素两条路径一致（ROI 读取与整图裁剪逐像素相同）。
+    """
+    im = load_image(path, cfg)
+    if cfg.roi_reads and supports_roi_reads(path):
+        resized, (ow, oh, nw, nh) = load_reduced(path, cfg.target_height)
+    else:
+        resized, (ow, oh, nw, nh) = resize_keep_h(im, cfg.target_height)
+    im_gray = np.array(resized.convert("L"))
+    im_bgr = cv2.cvtColor(np.array(im), cv2.COLOR_RGB2BGR)
+    return im_gray, im_bgr, (ow / nw, oh / nh)
+
+def _map_box(box_s, scale):
+    sx, sy = scale
+    return np.array([[int(x*sx), int(y*sy)] for x, y in box_s])
+
+def _memo(cache, key, fn):
+    """记忆化一个阶段，同时记下该阶段首次计算的耗时：返回 (value, 耗时s)"""
+    if key not in cache:
+        t0 = time.perf_counter()
+        value = fn()
+        cache[key] = (value, time.perf_counter() - t0)
+    return cache[key]
+
+def _sweep_image(path, combos, acc, verbose=False):
+    """
+    对单张图跑全部参数组合；图像只解码一次，
+    梯度按 sobel_ksize、检测按阈值、提取按裁剪/面积参数逐级记忆化。
+    每个组合累计两种耗时：
+      - standalone：它用到的每个阶段的耗时之和（无论是否命中缓存），可跨行比较
+      - incremental：本次扫描中实际新增的耗时（命中缓存的阶段不计）
+    """
+    decoded, grads, dets, exts = {}, {}, {}, {}
+    for i, (_, cfg) in enumerate(combos):
+        t0 = time.perf_counter()
+        kd = _stage_key(cfg, DECODE_KEYS)
+        (im_gray, im_bgr, scale), t_dec = _memo(decoded, kd, lambda: _decode(path, cfg))
+
+        kg = kd + _stage_key(cfg, GRADIENT_KEYS)
+        mag, t_grad = _memo(grads, kg, lambda: sobel_magnitude(im_gray, cfg.sobel_ksize))
+
+        def detect():
+            if cfg.detect_cascade:
+                # 与批处理一致走级联检测，复用已缓存的梯度幅值
+                _, ref_s, sam_s, _ = detect_regions_cascade(im_gray, cfg, mag=mag)
+            else:
+                ref_s, sam_s = detect_from_magnitude(mag, cfg.edge_thresh)
+            if ref_s is None or sam_s is None:
+                return None
+            return (_map_box(ref_s, scale), _map_box(sam_s, scale))
+
+        kt = kg + _stage_key(cfg, DETECT_KEYS)
+        boxes, t_det = _memo(dets, kt, detect)
+        standalone = t_dec + t_grad + t_det
+
+        if boxes is not None:
+            ref_box, sample_box = boxes
+            ke = kt + _stage_key(cfg, EXTRACT_KEYS)
+            (ref_346, sample_346), t_ext = _memo(exts, ke, lambda: (
+                extract_card_means(im_bgr, ref_box, cfg, draw_grid=False),
+                extract_card_means(im_bgr, sample_box, cfg, draw_grid=False)))
+            tf = time.perf_counter()
+            X, _ = build_features(ref_346, sample_346,
+                                  mode=cfg.feature_mode,
+                                  per_image_channel_norm=cfg.per_image_channel_norm)
+            standalone += t_ext + (time.perf_counter() - tf)
+            acc[i]["detected"] += 1
+            acc[i]["ref"].append(ref_346)
+            acc[i]["X"].append(X)
+        acc[i]["images"] += 1
+        acc[i]["standalone_s"] += standalone
+        acc[i]["incremental_s"] += time.perf_counter() - t0
+
+    if verbose:
+        print(f"[Sweep] {os.path.basename(path)}  decode={len(decoded)} grad={len(grads)} "
+              f"detect={len(dets)} extract={len(exts)}")
+
+def _stability(arrs):
+    """跨图像的平均标准差；少于两张时为 NaN"""
+    if len(arrs) < 2:
+        return float("nan")
+    return float(np.stack(arrs).std(axis=0).mean())
+
+def run_sweep(image_paths, base_cfg: PipelineConfig, grid, verbose=False):
+    """
+    参数扫描：对 grid 的每个组合统计
+      - success_rate：自动检测成功率
+      - ref_cv：参考卡 (3,4,6) 跨图像变异系数均值（同一张参考卡，越小越稳定）
+      - feat_std：特征跨图像标准差均值
+      - time_s / time_per_image_s：该组合单独运行的耗时（所用各阶段耗时之和，含缓存命中的阶段）
+      - incremental_s：本次扫描中该组合实际新增的耗时（依赖组合顺序，仅供参考）
+    返回：按组合顺序的行（dict）列表
+    """
+    combos = expand_grid(base_cfg, grid)
+    acc = [{"images": 0, "detected": 0, "standalone_s": 0.0, "incremental_s": 0.0, "ref": [], "X": []}
+           for _ in combos]
+    for p in image_paths:
+        _sweep_image(p, combos, acc, verbose=verbose)
+
+    rows = []
+    for (params, _), a in zip(combos, acc):
+        n = max(a["images"], 1)
+        if len(a["ref"]) >= 2:
+            ref = np.stack(a["ref"])
+            ref_cv = float((ref.std(axis=0) / (ref.mean(axis=0) + 1e-6)).mean())
+        else:
+            ref_cv = float("nan")
+        row = dict(params)
+        row.update({
+            "images": a["images"],
+            "detected": a["detected"],
+            "success_rate": a["detected"] / n,
+            "ref_cv": ref_cv,
+            "feat_std": _stability(a["X"]),
+            "time_s": a["standalone_s"],
+            "time_per_image_s": a["standalone_s"] / n,
+            "incremental_s": a["incremental_s"],
+        })
+        rows.append(row)
+    return rows
+
+def save_sweep_csv(rows, path):
+    if not rows:
+        return path
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        w = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        w.writeheader()
+        w.writerows(rows)
+    return path
+
+_SCALAR_CONV = {int: int, float: float, str: str, bool: lambda v: v.lower() in ("1", "true", "yes")}
+
+def _field_caster(name, tp):
+    """
+    标量字段按类型转换；Tuple[X, ...] 字段的单个取值用 ':' 分隔元素，
+    如 cascade_scales=0.5:1.5,0.75 → [(0.5, 1.5), (0.75,)]；其它类型不支持
+    """
+    if tp in _SCALAR_CONV:
+        return _SCALAR_CONV[tp]
+    if typing.get_origin(tp) is tuple:
+        args = typing.get_args(tp)
+        elem = args[0] if args else None
+        if elem in _SCALAR_CONV and (len(args) == 1 or args[1:] == (Ellipsis,)):
+            return lambda v: tuple(_SCALAR_CONV[elem](x) for x in v.split(":") if x)
+    raise ValueError(f"Field {name} ({tp}) cannot be swept from the command line")
+
+def _parse_grid(items):
+    """'edge_thresh=30,50,70' → {'edge_thresh': [30, 50, 70]}（按字段类型转换）"""
+    types = {f.name: f.type for f in fields(PipelineConfig)}
+    grid = {}
+    for item in items:
+        name, _, vals = item.partition("=")
+        if name not in types:
+            raise ValueError(f"Unknown PipelineConfig field: {name}")
+        cast = _field_caster(name, types[name])
+        grid[name] = [cast(v) for v in vals.split(",") if v]
+    return grid
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="PipelineConfig 参数扫描（复用解码与中间结果）")
+    ap.add_argument("--input", required=True, help="样本图像目录")
+    ap.add_argument("--grid", action="append", default=[], help="name=v1,v2,...，可重复")
+    ap.add_argument("--out", default="sweep.csv")
+    ap.add_argument("--limit", type=int, default=0, help="最多使用前 N 张图（0 = 全部）")
+    args = ap.parse_args(argv)
+
+    imgs = sorted(find_images(args.input))
+    if args.limit > 0:
+        imgs = imgs[:args.limit]
+    rows = run_sweep(imgs, PipelineConfig(), _parse_grid(args.grid), verbose=True)
+    for r in rows:
+        print(r)
+    print(f"[Sweep] {len(rows)} configs × {len(imgs)} images → {save_sweep_csv(rows, args.out)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# colorcard_kit/tests/conftest.py
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+def make_card_image(w=1200, h=900, seed=0):
+    """合成测试图：灰色背景上上下两块 6x12 色块色卡（RGB uint8）"""
+    rng = np.random.default_rng(seed)
+    im = np.full((h, w, 3), 90, np.uint8)
+    for y1, y2 in ((int(h * 0.12), int(h * 0.42)), (int(h * 0.55), int(h * 0.88))):
+        x1, x2 = int(w * 0.2), int(w * 0.8)
+        im[y1:y2, x1:x2] = 235
+        rows, cols = 6, 12
+        ch, cw = (y2 - y1) / rows, (x2 - x1) / cols
+        for r in range(rows):
+            for c in range(cols):
+                py1, px1 = int(y1 + r * ch + 3), int(x1 + c * cw + 3)
+                py2, px2 = int(y1 + (r + 1) * ch - 3), int(x1 + (c + 1) * cw - 3)
+                im[py1:py2, px1:px2] = rng.integers(20, 230, 3)
+    noise = rng.normal(0, 2, im.shape)
+    return np.clip(im + noise, 0, 255).astype(np.uint8)
+
+@pytest.fixture
+def card_jpg(tmp_path):
+    from PIL import Image
+    path = str(tmp_path / "card.jpg")
+    Image.fromarray(make_card_image()).save(path, quality=95)
+    return path
@@ -0,0 +1,90 @@
+# colorcard_kit/tests/test_cell_stats.py
+"""exact / clipped 每格统计与 numpy 逐像素结果对照（含退化格子）"""
+import numpy as np
+import pytest
+
+from config import PipelineConfig
+from extract import _cell_rects, _clipped_stats, _integral_stats, extract_card_stats, shrink_quad
+
+def _np_stats(patch):
+    px = patch.reshape(-1, 3).astype(np.float64)
+    return px.mean(axis=0), px.var(axis=0)
+
+def _np_clipped(patch, k):
+    px = patch.reshape(-1, 3).astype(np.float64)
+    m, v = px.mean(axis=0), px.var(axis=0)
+    keep = np.all(np.abs(px - m) <= k * (np.sqrt(v) + 1e-6), axis=1)
+    sel = px[keep] if keep.any() else px
+    return sel.mean(axis=0), sel.var(axis=0)
+
+@pytest.fixture
+def image():
+    return np.random.default_rng(1).integers(0, 256, (200, 300, 3), dtype=np.uint8)
+
+def test_integral_stats_match_numpy(image):
+    rng = np.random.default_rng(2)
+    centers = []
+    for _ in range(50):
+        x1, y1 = rng.integers(0, 290), rng.integers(0, 190)
+        centers.append((x1, y1, x1 + rng.integers(1, 300 - x1), y1 + rng.integers(1, 200 - y1)))
+    mean, var = _integral_stats(image, centers)
+    for (x1, y1, x2, y2), m, v in zip(centers, mean, var):
+        em, ev = _np_stats(image[y1:y2, x1:x2])
+        np.testing.assert_allclose(m, em, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(v, ev, rtol=1e-7, atol=1e-6)
+
+def test_integral_stats_degenerate_cells(image):
+    flat = np.full((20, 20, 3), 77, np.uint8)
+    # 单像素 / 常数块：方差为 0 且不为负
+    mean, var = _integral_stats(flat, [(3, 4, 4, 5), (0, 0, 20, 20)])
+    np.testing.assert_allclose(mean, 77.0)
+    assert np.all(var == 0.0)
+    # 空格子（面积为 0）不产生 NaN；越界部分按图像边界截断
+    mean, var = _integral_stats(image, [(10, 10, 10, 30), (280, 180, 400, 400)])
+    assert np.all(np.isfinite(mean)) and np.all(np.isfinite(var))
+    em, ev = _np_stats(image[180:200, 280:300])
+    np.testing.assert_allclose(mean[1], em, atol=1e-9)
+    np.testing.assert_allclose(var[1], ev, rtol=1e-7, atol=1e-6)
+
+@pytest.mark.parametrize("k", [1.0, 2.5])
+def test_clipped_stats_match_numpy(image, k):
+    rng = np.random.default_rng(3)
+    for _ in range(20):
+        x1, y1 = rng.integers(0, 280), rng.integers(0, 180)
+        patch = image[y1:y1 + rng.integers(2, 20), x1:x1 + rng.integers(2, 20)]
+        m0, v0 = _np_stats(patch)
+        m, v = _clipped_stats(patch, m0, v0, k)
+        em, ev = _np_clipped(patch, k)
+        np.testing.assert_allclose(m, em, rtol=1e-5)
+        np.testing.assert_allclose(v, ev, rtol=1e-4, atol=1e-3)
+
+def test_clipped_stats_degenerate_cells():
+    # 常数块：全部保留；空块：原样返回积分图结果
+    flat = np.full((5, 5, 3), 12, np.uint8)
+    m, v = _clipped_stats(flat, np.full(3, 12.0), np.zeros(3), 2.5)
+    np.testing.assert_allclose(m, 12.0)
+    np.testing.assert_allclose(v, 0.0)
+    empty = flat[:0]
+    m0, v0 = np.full(3, 1.0), np.full(3, 2.0)
+    m, v = _clipped_stats(empty, m0, v0, 2.5)
+    assert m is m0 and v is v0
+
+def test_clipped_removes_outliers():
+    patch = np.full((10, 10, 3), 100, np.uint8)
+    patch[0, 0] = 255
+    m0, v0 = _np_stats(patch)
+    m, v = _clipped_stats(patch, m0, v0, 2.5)
+    np.testing.assert_allclose(m, 100.0)
+    np.testing.assert_allclose(v, 0.0, atol=1e-6)
+
+@pytest.mark.parametrize("mode", ["exact", "clipped"])
+def test_extract_card_stats_per_cell(image, mode):
+    cfg = PipelineConfig(cell_stats=mode, grid_rows=4, grid_cols=6)
+    box = np.array([[250, 20], [40, 20], [40, 180], [250, 180]])
+    means, variances = extract_card_stats(image.copy(), box, cfg, draw_grid=False)
+    assert means.shape == variances.shape == (3, 4, 6)
+    for r, c, _, (cx1, cy1, cx2, cy2) in _cell_rects(shrink_quad(box, cfg.card_crop_long, cfg.card_crop_short), cfg):
+        patch = image[cy1:cy2, cx1:cx2]
+        em, ev = _np_stats(patch) if mode == "exact" else _np_clipped(patch, cfg.clip_sigma)
+        np.testing.assert_allclose(means[:, r, c], em[::-1], rtol=1e-5)
+        np.testing.assert_allclose(variances[:, r, c], ev[::-1], rtol=1e-4, atol=1e-3)
@@ -0,0 +1,85 @@
+# colorcard_kit/tests/test_dataset_stats.py
+"""在线统计（Welford）+ 分片合并（Chan）与 numpy 整体计算对照"""
+import numpy as np
+import pytest
+
+from dataset_stats import DatasetStats, RunningStats, apply_dataset_norm
+
+def _shards(data, sizes):
+    out, i = [], 0
+    for n in sizes:
+        out.append(data[i:i + n])
+        i += n
+    return out
+
+def _stats_of(arrs):
+    rs = RunningStats()
+    for x in arrs:
+        rs.update(x)
+    return rs
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    # 各通道尺度不同，检查池化方差不被平均掉
+    return rng.normal([1.0, -3.0, 10.0], [0.5, 2.0, 7.0], (57, 4, 6, 3)).transpose(0, 3, 1, 2)
+
+@pytest.mark.parametrize("sizes", [(57,), (20, 20, 17), (1, 0, 30, 26), (56, 1)])
+def test_update_and_merge_match_numpy(data, sizes):
+    merged = RunningStats()
+    for shard in _shards(data, sizes):
+        merged.merge(_stats_of(shard))
+    assert merged.n == len(data)
+    np.testing.assert_allclose(merged.mean, data.mean(axis=0), rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(merged.var, data.var(axis=0), rtol=1e-10)
+    np.testing.assert_allclose(merged.std, data.std(axis=0), rtol=1e-10)
+    np.testing.assert_array_equal(merged.min, data.min(axis=0))
+    np.testing.assert_array_equal(merged.max, data.max(axis=0))
+
+@pytest.mark.parametrize("sizes", [(57,), (10, 47), (19, 19, 19)])
+def test_channel_summary_matches_numpy(data, sizes):
+    merged = RunningStats()
+    for shard in _shards(data, sizes):
+        merged.merge(_stats_of(shard))
+    ch = merged.channel_summary()
+    # 通道级 = 把所有图、所有格子的值放在一起
+    per_ch = data.transpose(1, 0, 2, 3).reshape(3, -1)
+    np.testing.assert_allclose(ch["mean"], per_ch.mean(axis=1), rtol=1e-10)
+    np.testing.assert_allclose(ch["std"], per_ch.std(axis=1), rtol=1e-10)
+    np.testing.assert_array_equal(ch["min"], per_ch.min(axis=1))
+    np.testing.assert_array_equal(ch["max"], per_ch.max(axis=1))
+
+def test_merge_rejects_shape_mismatch():
+    a = _stats_of([np.zeros((3, 2, 2))])
+    b = _stats_of([np.zeros((3, 4, 6))])
+    with pytest.raises(ValueError):
+        a.merge(b)
+
+def test_dataset_stats_save_load_roundtrip(data, tmp_path):
+    ds = DatasetStats("log_ratio")
+    for x in data:
+        ds.update("features_raw", x)
+    loaded = DatasetStats.load(ds.save(str(tmp_path / "stats.npz")))
+    assert loaded.feature_mode == "log_ratio"
+    np.testing.assert_allclose(loaded["features_raw"].var, data.var(axis=0), rtol=1e-10)
+
+def test_apply_dataset_norm_levels(data):
+    ds = DatasetStats("log_ratio")
+    for x in data:
+        ds.update("features_raw", x)
+    z = np.stack([apply_dataset_norm(x, ds, level="cell", feature_mode="log_ratio") for x in data])
+    np.testing.assert_allclose(z.mean(axis=0), 0.0, atol=1e-5)
+    np.testing.assert_allclose(z.std(axis=0), 1.0, atol=1e-4)
+    zc = np.stack([apply_dataset_norm(x, ds, level="channel") for x in data])
+    per_ch = zc.transpose(1, 0, 2, 3).reshape(3, -1)
+    np.testing.assert_allclose(per_ch.mean(axis=1), 0.0, atol=1e-5)
+    np.testing.assert_allclose(per_ch.std(axis=1), 1.0, atol=1e-4)
+
+def test_apply_dataset_norm_rejects_feature_mode_mismatch(data):
+    ds = DatasetStats("ratio")
+    for x in data:
+        ds.update("features_raw", x)
+    with pytest.raises(ValueError, match="feature_mode"):
+        apply_dataset_norm(data[0], ds, feature_mode="log_ratio")
+    with pytest.raises(ValueError, match="shape"):
+        apply_dataset_norm(data[0, :, :2], ds, feature_mode="ratio")
@@ -0,0 +1,131 @@
+# colorcard_kit/tests/test_manual_flow.py
+"""手动框选流程：解码/提取都走预算子进程，本进程只做框选"""
+import csv
+import os
+from dataclasses import replace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import detect
+import manual_select
+from config import PipelineConfig
+from conftest import make_card_image
+from pipeline import DETECT_LOG, make_runner, process_single, process_with_budget
+
+CFG = PipelineConfig(cell_stats="exact", save_vis=False, save_extras=False, image_timeout_s=60.0)
+
+class FakeSelector:
+    """代替 OpenCV 窗口：在给定的显示图上框出合成图中的两块色卡"""
+    cancel = False
+
+    def __init__(self, disp, title):
+        self.h, self.w = disp.shape[:2]
+
+    def run(self):
+        if self.cancel:
+            return None, None
+        x1, x2 = 0.2 * self.w, 0.8 * self.w
+        def box(y1, y2):
+            return np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]]).round().astype(int)
+        return box(0.12 * self.h, 0.42 * self.h), box(0.55 * self.h, 0.88 * self.h)
+
+@pytest.fixture
+def card_png(tmp_path):
+    # PNG 不支持 ROI 读取：若在本进程生成预览就会整图解码
+    path = str(tmp_path / "card.png")
+    Image.fromarray(make_card_image()).save(path)
+    return path
+
+@pytest.fixture
+def no_local_decode(monkeypatch):
+    """本进程内禁止任何解码；预算子进程（spawn）不受影响"""
+    def boom(*a, **k):
+        raise AssertionError("decoded in the UI process")
+    monkeypatch.setattr(detect, "load_image", boom)
+    monkeypatch.setattr(detect, "load_reduced", boom)
+    monkeypatch.setattr(manual_select, "TwoRectSelector", FakeSelector)
+
+def _levels(out):
+    with open(os.path.join(out, DETECT_LOG), newline="", encoding="utf-8") as f:
+        return [r["level"] for r in csv.DictReader(f)]
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_force_manual_runs_in_budget_subprocess(card_png, tmp_path, no_local_decode, use_cache):
+    cfg = replace(CFG, force_manual=True)
+    out = str(tmp_path / "out")
+    runner = make_runner(cfg)
+    cache = manual_select.PreviewCache(cfg) if use_cache else None
+    try:
+        if cache is not None:
+            cache.prefetch([card_png])
+        res = process_with_budget(card_png, str(tmp_path), out, cfg, runner=runner, preview_cache=cache)
+    finally:
+        runner.close()
+        if cache is not None:
+            cache.close()
+    assert res["detect_level"] == "manual"
+    assert _levels(out) == ["manual"]
+    ref = np.load(res["ref_346"])
+    assert ref.shape == (3, CFG.grid_rows, CFG.grid_cols) and np.isfinite(ref).all()
+
+def test_subprocess_extraction_matches_in_process(card_jpg, tmp_path, monkeypatch):
+    monkeypatch.setattr(manual_select, "TwoRectSelector", FakeSelector)
+    cfg = replace(CFG, force_manual=True)
+    runner = make_runner(cfg)
+    try:
+        sub = process_with_budget(card_jpg, str(tmp_path), str(tmp_path / "sub"), cfg, runner=runner)
+    finally:
+        runner.close()
+    local = process_with_budget(card_jpg, str(tmp_path), str(tmp_path / "local"), cfg)
+    for key in ("ref_346", "sample_346"):
+        np.testing.assert_array_equal(np.load(sub[key]), np.load(local[key]))
+
+def test_cancelled_selection_is_logged_as_skip(card_png, tmp_path, monkeypatch):
+    monkeypatch.setattr(FakeSelector, "cancel", True)
+    monkeypatch.setattr(manual_select, "TwoRectSelector", FakeSelector)
+    out = str(tmp_path / "out")
+    assert process_with_budget(card_png, str(tmp_path), out, replace(CFG, force_manual=True)) is None
+    assert _levels(out) == ["skip"]
+
+def test_preview_cache_get_does_not_block(card_png):
+    cache = manual_select.PreviewCache(CFG, timeout=0.0)
+    try:
+        assert cache.get(card_png) is None  # 未预取
+        cache.prefetch([card_png])
+        assert cache.get(card_png, timeout=60)[0].ndim == 3
+    finally:
+        cache.close()
+
+def test_force_manual_selects_before_decoding(card_jpg, tmp_path, monkeypatch):
+    events = []
+    real = detect.load_reduced
+
+    def load_reduced(path, target_h, cancel=None):
+        events.append(("decode", target_h))
+        return real(path, target_h, cancel=cancel)
+
+    class Recording(FakeSelector):
+        def run(self):
+            events.append(("select", None))
+            return super().run()
+
+    monkeypatch.setattr(detect, "load_reduced", load_reduced)
+    monkeypatch.setattr(manual_select, "TwoRectSelector", Recording)
+    cfg = replace(CFG, force_manual=True)
+    res = process_single(card_jpg, str(tmp_path), str(tmp_path / "out"), cfg)
+    assert res["detect_level"] == "manual"
+    # 预览（最长边 manual_downscale）→ 框选 → 检测尺寸的降采样读取
+    assert events == [("decode", 900), ("select", None), ("decode", cfg.target_height)]
+
+def test_failed_detection_falls_back_without_full_decode(tmp_path, monkeypatch):
+    path = str(tmp_path / "blank.jpg")
+    Image.fromarray(np.full((900, 1200, 3), 120, np.uint8)).save(path)
+
+    def boom(*a, **k):
+        raise AssertionError("full decode")
+    monkeypatch.setattr(detect, "load_image", boom)
+    monkeypatch.setattr(manual_select, "TwoRectSelector", FakeSelector)
+    res = process_single(path, str(tmp_path), str(tmp_path / "out"), CFG)
+    assert res["detect_level"] == "manual"
@@ -0,0 +1,93 @@
+# colorcard_kit/tests/test_roi_reads.py
+"""ROI 读取与整图解码逐像素一致，且各支持的布局不回退到整图解码"""
+import io
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image, TiffImagePlugin, TiffTags
+
+import detect
+from config import PipelineConfig
+from conftest import make_card_image
+
+RECTS = [(250, 100, 970, 380), (240, 490, 961, 800), (0, 0, 1200, 1), (1199, 899, 1200, 900)]
+
+def _save_tiled_deflate(path, arr, tile=128):
+    """Pillow 不能写分块 TIFF：手工写一个 Deflate 压缩、128x128 分块的 RGB TIFF"""
+    h, w = arr.shape[:2]
+    chunks = []
+    for ty in range(0, h, tile):
+        for tx in range(0, w, tile):
+            block = np.zeros((tile, tile, 3), np.uint8)
+            part = arr[ty:ty + tile, tx:tx + tile]
+            block[:part.shape[0], :part.shape[1]] = part
+            chunks.append(zlib.compress(block.tobytes()))
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=b"II")
+    tags = {256: w, 257: h, 258: (8, 8, 8), 259: 8, 262: 2, 277: 3, 284: 1,
+            322: tile, 323: tile, 325: tuple(len(c) for c in chunks), 324: (0,) * len(chunks)}
+    for tag, v in tags.items():
+        ifd[tag] = v
+        ifd.tagtype[tag] = TiffTags.SHORT if tag in (258, 259, 262, 277, 284) else TiffTags.LONG
+    base = 8 + len(ifd.tobytes(8))
+    ifd[324] = tuple(base + o for o in np.cumsum([0] + [len(c) for c in chunks[:-1]]).tolist())
+    with open(path, "wb") as f:
+        buf = io.BytesIO()
+        ifd.save(buf)
+        f.write(buf.getvalue())
+        f.write(b"".join(chunks))
+
+@pytest.fixture(scope="module")
+def image():
+    return make_card_image(seed=3)
+
+@pytest.fixture(scope="module", params=["jpeg", "jpeg_progressive", "tiff_raw_single", "tiff_raw_strips",
+                                        "tiff_lzw_strips", "tiff_deflate_strips", "tiff_deflate_tiled"])
+def sample(request, image, tmp_path_factory):
+    d = tmp_path_factory.mktemp("roi")
+    im = Image.fromarray(image)
+    kind = request.param
+    path = str(d / (kind + (".jpg" if kind.startswith("jpeg") else ".tif")))
+    if kind == "jpeg":
+        im.save(path, quality=90)
+    elif kind == "jpeg_progressive":
+        im.save(path, quality=90, progressive=True)
+    elif kind == "tiff_raw_single":
+        im.save(path)
+    elif kind == "tiff_raw_strips":
+        im.save(path, tiffinfo={278: 64})
+    elif kind == "tiff_lzw_strips":
+        im.save(path, compression="tiff_lzw", tiffinfo={278: 64})
+    elif kind == "tiff_deflate_strips":
+        im.save(path, compression="tiff_adobe_deflate", tiffinfo={278: 37})
+    else:
+        _save_tiled_deflate(path, image)
+    return kind, path
+
+def test_roi_layout_supported(sample):
+    assert detect.supports_roi_reads(sample[1])
+
+def test_read_regions_match_full_decode(sample, capsys):
+    kind, path = sample
+    full = np.array(Image.open(path).convert("RGB"))
+    crops = detect.read_regions(path, RECTS, PipelineConfig())
+    for (x1, y1, x2, y2), crop in zip(RECTS, crops):
+        np.testing.assert_array_equal(crop, full[y1:y2, x1:x2])
+    assert "fallback" not in capsys.readouterr().out
+
+def test_read_regions_skips_full_decode(sample, monkeypatch):
+    def no_full_decode(*a, **k):
+        raise AssertionError("full decode")
+    monkeypatch.setattr(detect, "load_image", no_full_decode)
+    assert len(detect.read_regions(sample[1], RECTS[:2], PipelineConfig())) == 2
+
+def test_load_reduced_matches_size(sample, capsys):
+    small, (ow, oh, nw, nh) = detect.load_reduced(sample[1], 256)
+    assert (ow, oh) == (1200, 900) and small.size == (nw, nh) == (341, 256)
+    assert "fallback" not in capsys.readouterr().out
+
+def test_single_strip_compressed_tiff_not_supported(image, tmp_path):
+    # 整幅一条的压缩 TIFF 没有可跳过的块：不走 ROI 路径
+    path = str(tmp_path / "one.tif")
+    Image.fromarray(image).save(path, compression="tiff_lzw", tiffinfo={278: 900})
+    assert not detect.supports_roi_reads(path)
@@ -0,0 +1,97 @@
+# colorcard_kit/tests/test_service.py
+"""本地特征服务：仅在 127.0.0.1 上起服务（port=0 取随机端口），走真实 HTTP"""
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from config import PipelineConfig
+from service import FeatureService
+
+CFG = PipelineConfig(allow_manual=False, save_vis=False, cell_stats="exact")  # exact：结果确定，便于比较
+
+def _request(svc, path, body=None, content_type="application/json", query=""):
+    host, port = svc.address
+    req = urllib.request.Request(f"http://{host}:{port}{path}{query}", data=body)
+    if body is not None:
+        req.add_header("Content-Type", content_type)
+    try:
+        with urllib.request.urlopen(req, timeout=60) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def _post_json(svc, obj):
+    return _request(svc, "/features", json.dumps(obj).encode("utf-8"))
+
+@pytest.fixture(scope="module")
+def service():
+    with FeatureService(CFG, port=0, workers=1, batch_wait_ms=0) as svc:
+        yield svc
+
+@pytest.fixture(scope="module")
+def card_path(tmp_path_factory):
+    from PIL import Image
+    from conftest import make_card_image
+    path = str(tmp_path_factory.mktemp("svc") / "card.jpg")
+    Image.fromarray(make_card_image()).save(path, quality=95)
+    return path
+
+def test_json_path_request(service, card_path):
+    code, res = _post_json(service, {"path": card_path})
+    assert code == 200 and res["ok"], res
+    assert res["features"]["shape"] == [3, CFG.grid_rows, CFG.grid_cols]
+    assert res["ref_346"]["shape"] == [3, CFG.grid_rows, CFG.grid_cols]
+    assert res["detect_level"] is not None
+
+def test_json_path_request_writes_files(service, card_path, tmp_path):
+    code, res = _post_json(service, {"path": card_path, "output_dir": str(tmp_path)})
+    assert code == 200 and res["ok"], res
+    assert res["files"]["features"].startswith(str(tmp_path))
+
+def test_raw_bytes_request_matches_path_request(service, card_path):
+    with open(card_path, "rb") as f:
+        data = f.read()
+    code, res = _request(service, "/features", data, content_type="image/jpeg", query="?ext=jpg")
+    assert code == 200 and res["ok"], res
+    _, by_path = _post_json(service, {"path": card_path})
+    assert res["features"]["data"] == by_path["features"]["data"]
+
+def test_bad_json_is_400(service):
+    code, res = _request(service, "/features", b"{not json")
+    assert code == 400 and not res["ok"]
+    assert "bad json" in res["error"]
+
+def test_missing_path_is_400(service):
+    code, res = _post_json(service, {"output_dir": "/tmp"})
+    assert code == 400 and "missing 'path'" in res["error"]
+
+def test_missing_file_is_422(service, tmp_path):
+    code, res = _post_json(service, {"path": str(tmp_path / "nope.jpg")})
+    assert code == 422 and "file not found" in res["error"]
+
+def test_unknown_route_is_404(service):
+    assert _request(service, "/nope")[0] == 404
+
+def test_health_and_metrics(service, card_path):
+    assert _request(service, "/health") == (200, {"ok": True})
+    before = _request(service, "/metrics")[1]["requests"]
+    _post_json(service, {"path": card_path})
+    code, m = _request(service, "/metrics")
+    assert code == 200
+    assert m["requests"] == before + 1
+    for k in ("errors", "rejected", "batches", "mean_batch_size", "latency_ms_p50", "latency_ms_p99"):
+        assert k in m
+
+def test_503_when_max_pending_exceeded(card_path):
+    # 单批最多 2 个、凑批等 2s：先占住唯一的在途名额，HTTP 请求必被拒绝
+    with FeatureService(CFG, port=0, workers=1, max_pending=1, batch_size=2, batch_wait_ms=2000) as svc:
+        held = svc.submit({"path": card_path})
+        assert held is not None
+        code, res = _post_json(svc, {"path": card_path})
+        assert code == 503 and not res["ok"]
+        assert _request(svc, "/metrics")[1]["rejected"] == 1
+        assert held.result(timeout=60)["ok"]
+        code, res = _post_json(svc, {"path": card_path})
+        assert code == 200 and res["ok"]
@@ -0,0 +1,35 @@
+# colorcard_kit/tests/test_startup.py
+"""
+启动开销回归：import pipeline 不应加载 OpenCV / PIL / matplotlib / tkinter / rawpy，
+且在全新解释器中的导入耗时应在预算内。
+"""
+import os
+import sys
+import json
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("cv2", "PIL", "matplotlib", "tkinter", "rawpy")
+IMPORT_BUDGET_S = 1.0
+
+_PROBE = (
+    "import sys, time, json\n"
+    "t0 = time.perf_counter()\n"
+    "import pipeline\n"
+    "dt = time.perf_counter() - t0\n"
+    "heavy = sorted(m for m in sys.modules if m.split('.')[0] in %r)\n"
+    "print(json.dumps({'dt': dt, 'heavy': heavy}))\n"
+) % (HEAVY,)
+
+def _probe():
+    out = subprocess.run([sys.executable, "-c", _PROBE], cwd=ROOT, capture_output=True,
+                         text=True, check=True, timeout=60)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def test_import_pipeline_skips_heavy_modules():
+    res = _probe()
+    assert res["heavy"] == [], f"heavy modules loaded at import: {res['heavy']}"
+
+def test_import_pipeline_within_budget():
+    res = _probe()
+    assert res["dt"] < IMPORT_BUDGET_S, f"import pipeline took {res['dt']:.3f}s"
@@ -8,7 +8,9 @@ from tkinter import ttk
 
 from config import PipelineConfig
 from io_utils import find_images
-from pipeline import process_single
+from dataset_stats import DatasetStats
+from pipeline import process_with_budget, make_runner, summarize_detect_log, DETECT_LOG
+from budget import BudgetExceeded, Cancelled, quarantine, load_quarantine
 
 class App(tk.Tk):
     def __init__(self):
@@ -18,6 +20,8 @@ class App(tk.Tk):
         self.resizable(True, True)
         self._stop_flag = threading.Event()
         self._worker = None
+        self._previews = None
+        self._stats = None
         self._build_ui()
 
     def _build_ui(self):
@@ -70,6 +74,12 @@ class App(tk.Tk):
         ttk.Label(prm, text="sample_center_area").grid(row=0, column=4, sticky="e")
         ttk.Entry(prm, textvariable=self.var_sample_center_area, width=10).grid(row=0, column=5, sticky="w")
         ttk.Label(prm, text="(0~1，中间采样面积比例)").grid(row=0, column=6, sticky="w")
+        self.var_cell_stats = tk.StringVar(value="sample")
+        ttk.Label(prm, text="cell_stats").grid(row=1, column=4, sticky="e")
+        ttk.OptionMenu(prm, self.var_cell_stats, "sample", "sample", "exact", "clipped").grid(row=1, column=5, sticky="w")
+        self.var_clip_sigma = tk.DoubleVar(value=2.5)
+        ttk.Label(prm, text="clip_sigma").grid(row=2, column=4, sticky="e")
+        ttk.Entry(prm, textvariable=self.var_clip_sigma, width=10).grid(row=2, column=5, sticky="w")
 
         # 特征模式
         feat = ttk.LabelFrame(self, text="特征输出")
@@ -81,6 +91,13 @@ class App(tk.Tk):
         ttk.Checkbutton(feat, text="per_image_channel_norm", variable=self.var_norm).grid(row=0, column=2, sticky="w")
         self.var_save_extras = tk.BooleanVar(value=True)
         ttk.Checkbutton(feat, text="save_extras (ratio/logratio)", variable=self.var_save_extras).grid(row=0, column=3, sticky="w")
+        self.var_save_vis = tk.BooleanVar(value=True)
+        ttk.Checkbutton(feat, text="save_vis", variable=self.var_save_vis).grid(row=0, column=4, sticky="w")
+        self.var_dataset_norm = tk.StringVar(value="")
+        ttk.Label(feat, text="dataset_norm").grid(row=1, column=0, sticky="e")
+        ttk.OptionMenu(feat, self.var_dataset_norm, "", "", "cell", "channel").grid(row=1, column=1, sticky="w")
+        self.stats_entry = ttk.Entry(feat, width=48); self.stats_entry.grid(row=1, column=2, columnspan=2, sticky="we")
+        ttk.Button(feat, text="选择统计文件", command=self._choose_stats).grid(row=1, column=4, sticky="w")
 
         # 手动回退 & RAW
         extf = ttk.LabelFrame(self, text="扩展功能")
@@ -100,6 +117,16 @@ class App(tk.Tk):
         ttk.Checkbutton(extf, text="raw_use_camera_wb", variable=self.var_raw_wb).grid(row=1, column=1, sticky="w")
         ttk.Label(extf, text="raw_output_bps").grid(row=1, column=2, sticky="e")
         ttk.Entry(extf, textvariable=self.var_raw_bps, width=10).grid(row=1, column=3, sticky="w")
+        self.var_roi_reads = tk.BooleanVar(value=True)
+        ttk.Checkbutton(extf, text="roi_reads (JPEG/TIFF 低内存读取)", variable=self.var_roi_reads).grid(row=2, column=0, columnspan=2, sticky="w")
+
+        self.var_timeout = tk.DoubleVar(value=120.0)
+        self.var_mem_mb = tk.IntVar(value=0)
+        ttk.Label(extf, text="image_timeout_s").grid(row=3, column=0, sticky="e")
+        ttk.Entry(extf, textvariable=self.var_timeout, width=10).grid(row=3, column=1, sticky="w")
+        ttk.Label(extf, text="image_mem_mb").grid(row=3, column=2, sticky="e")
+        ttk.Entry(extf, textvariable=self.var_mem_mb, width=10).grid(row=3, column=3, sticky="w")
+        ttk.Label(extf, text="(0 = 不限；超出即隔离)").grid(row=3, column=4, sticky="w")
 
         # 控制区
         ctrl = ttk.Frame(self); ctrl.pack(fill="x", **pad)
@@ -126,6 +153,10 @@ class App(tk.Tk):
         d = filedialog.askdirectory(title="选择输出目录")
         if d: self.out_entry.delete(0, tk.END); self.out_entry.insert(0, d)
 
+    def _choose_stats(self):
+        f = filedialog.askopenfilename(title="选择 dataset_stats.npz", filetypes=[("npz", "*.npz")])
+        if f: self.stats_entry.delete(0, tk.END); self.stats_entry.insert(0, f)
+
     def _open_out(self):
         outp = self.out_entry.get().strip()
         if outp and os.path.isdir(outp):
@@ -153,12 +184,29 @@ class App(tk.Tk):
 
         imgs = find_images(inp)
         if not imgs: messagebox.showwarning("提示", "未在输入目录找到图像文件"); return
+        # 之前超出预算被隔离的图像不再处理（删除 quarantine.csv 可重试）
+        quarantined = load_quarantine(outp)
+        skipped = [p for p in imgs if p in quarantined]
+        imgs = [p for p in imgs if p not in quarantined]
+        if not imgs: messagebox.showwarning("提示", "输入目录中的图像均已被隔离（见 quarantine.csv）"); return
+
+        # 可能手动标注时，后台为即将处理的图预生成预览（随进度前移的窗口）：
+        # 强制手动每张都要用，窗口放大；仅回退时只有少数会用到，窗口小一些
+        self._previews = None
+        if cfg.allow_manual or cfg.force_manual:
+            from manual_select import PreviewCache
+            self._previews = PreviewCache(cfg, capacity=32 if cfg.force_manual else 8)
+            self._previews.prefetch(imgs)
+        log_path = os.path.join(outp, DETECT_LOG)
+        if os.path.exists(log_path): os.remove(log_path)  # 每次运行重新记录
 
         self._stop_flag = threading.Event()
         self.progress.configure(maximum=len(imgs), value=0)
         self.log.delete("1.0", tk.END)
         self.status_var.set(f"准备开始：共 {len(imgs)} 张")
+        if skipped: self._append_log(f"[隔离] 跳过 {len(skipped)} 张已隔离图像（见 quarantine.csv）")
         self.open_btn.configure(state="disabled")
+        self._stats = DatasetStats(cfg.feature_mode)
 
         self._worker = threading.Thread(target=self._run_worker, args=(imgs, inp, outp, cfg), daemon=True)
         self._worker.start()
@@ -175,6 +223,7 @@ class App(tk.Tk):
         ksz = int(self.var_sobel_ksize.get()); thr = int(self.var_edge_thresh.get())
         ccl = float(self.var_card_crop_long.get()); ccs = float(self.var_card_crop_short.get())
         area = float(self.var_sample_center_area.get())
+        clip = float(self.var_clip_sigma.get())
         if rows <= 0 or cols <= 0: raise ValueError("grid_rows / grid_cols 必须为正整数")
         if th < 64: raise ValueError("target_height 过小（建议 ≥ 256）")
         if sc <= 0: raise ValueError("sample_count 必须为正整数")
@@ -182,45 +231,77 @@ class App(tk.Tk):
         if thr <= 0: raise ValueError("edge_thresh 必须为正整数")
         if not (0.0 <= ccl < 0.5) or not (0.0 <= ccs < 0.5): raise ValueError("card_crop_* 建议在 [0,0.5) 内")
         if not (0.0 < area <= 1.0): raise ValueError("sample_center_area 需在 (0,1] 内")
+        if clip <= 0: raise ValueError("clip_sigma 必须为正数")
+        timeout = float(self.var_timeout.get()); mem_mb = int(self.var_mem_mb.get())
+        if timeout < 0 or mem_mb < 0: raise ValueError("image_timeout_s / image_mem_mb 不能为负")
+        dnorm, dpath = self.var_dataset_norm.get(), self.stats_entry.get().strip()
+        if dnorm and not os.path.isfile(dpath): raise ValueError("dataset_norm 需要有效的 dataset_stats.npz")
 
         cfg = PipelineConfig(
             grid_rows=rows, grid_cols=cols, target_height=th, sample_count=sc,
             sobel_ksize=ksz, edge_thresh=thr,
             sample_center_area=area,
+            cell_stats=self.var_cell_stats.get(), clip_sigma=clip,
             feature_mode=self.var_feature_mode.get(),
             per_image_channel_norm=bool(self.var_norm.get()),
             save_extras=bool(self.var_save_extras.get()),
+            save_vis=bool(self.var_save_vis.get()),
+            dataset_norm=dnorm, dataset_stats_path=dpath,
             allow_manual=bool(self.var_allow_manual.get()),
             force_manual=bool(self.var_force_manual.get()),
             manual_downscale=int(self.var_manual_downscale.get()),
             prefer_raw_linear=bool(self.var_prefer_raw.get()),
             raw_use_camera_wb=bool(self.var_raw_wb.get()),
             raw_output_bps=int(self.var_raw_bps.get()),
+            roi_reads=bool(self.var_roi_reads.get()),
+            image_timeout_s=timeout, image_mem_mb=mem_mb,
         )
         cfg.card_crop_long = ccl; cfg.card_crop_short = ccs
         return cfg
 
     def _run_worker(self, imgs, inp, outp, cfg: PipelineConfig):
         ok = fail = 0
+        runner = make_runner(cfg, self._stop_flag)
         for i, p in enumerate(imgs, 1):
             if self._stop_flag.is_set():
                 self._append_log(f"[停止] 已中断，最后处理到：{i-1}/{len(imgs)}"); break
             try:
-                res = process_single(p, inp, outp, cfg)
+                res = process_with_budget(p, inp, outp, cfg, runner=runner, preview_cache=self._previews,
+                                          stats=self._stats, stop_event=self._stop_flag)
                 if res:
                     ok += 1
-                    vis_rel = os.path.relpath(res["vis"], outp) if "vis" in res else "(no vis)"
-                    self._append_log(f"[OK] {i}/{len(imgs)}  {os.path.basename(p)}  →  {vis_rel}")
+                    vis_rel = os.path.relpath(res["vis"], outp) if res.get("vis") else "(no vis)"
+                    self._append_log(f"[OK] {i}/{len(imgs)}  {os.path.basename(p)}  →  {vis_rel}"
+                                     f"  [{res['detect_level']} conf={res['confidence']:.2f}]")
                 else:
                     fail += 1
                     self._append_log(f"[SKIP] {i}/{len(imgs)}  {os.path.basename(p)}  未检测到两块区域")
+            except BudgetExceeded as e:
+                fail += 1
+                quarantine(outp, p, e.reason)
+                self._append_log(f"[隔离] {i}/{len(imgs)}  {os.path.basename(p)}  {e.reason}")
+            except Cancelled:
+                self._append_log(f"[停止] 已中断，最后处理到：{i-1}/{len(imgs)}"); break
             except Exception as e:
                 fail += 1
                 self._append_log(f"[ERR] {i}/{len(imgs)}  {os.path.basename(p)}  {e}\n{traceback.format_exc(limit=2)}")
+            if self._previews is not None:
+                self._previews.discard(p)  # 预生成窗口前移
             self.progress.configure(value=i)
             self.status_var.set(f"进度：{i}/{len(imgs)}  成功 {ok}  失败 {fail}")
             self.update_idletasks()
 
+        if runner is not None:
+            runner.close()
+        if self._previews is not None:
+            self._previews.close()
+        if ok:
+            stats_path = self._stats.save(os.path.join(outp, "dataset_stats.npz"))
+            self._append_log(f"[数据集统计] {ok} 张 → {os.path.relpath(stats_path, outp)}")
+        summ = summarize_detect_log(outp)
+        levels = "  ".join(f"{k}={v}" for k, v in summ["levels"].items())
+        costs = "  ".join(f"{k}={v:.1f}ms" for k, v in summ["stage_ms"].items())
+        self._append_log(f"[检测汇总] {levels}  手动 {summ['manual']}  跳过 {summ['skip']}\n[各级平均耗时] {costs}")
         self.status_var.set("完成" if not self._stop_flag.is_set() else "任务已停止")
         self.open_btn.configure(state="normal")
 
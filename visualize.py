@@ -1,7 +1,11 @@
 # colorcard_kit/visualize.py
 import os
 import numpy as np
-import matplotlib.pyplot as plt
+
+def _plt():
+    """matplotlib 较重，仅在真正出图时导入"""
+    import matplotlib.pyplot as plt
+    return plt
 
 def _rgb346_to_cellcolor(rgb_346):
     arr = np.transpose(rgb_346, (1, 2, 0))  # (4,6,3)
@@ -41,7 +45,7 @@ def _heatmap(ax, mat, title, cmap="viridis", vmin=None, vmax=None, with_cbar=Tru
     ax.set_xlabel("col"); ax.set_ylabel("row")
     ax.grid(color="k", linestyle="-", linewidth=0.5)
     if with_cbar:
-        plt.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+        _plt().colorbar(im, ax=ax, fraction=0.046, pad=0.04)
     return im
 
 def visualize_pair(image_path,
@@ -59,6 +63,7 @@ def visualize_pair(image_path,
                             若 mode 为 'ratio' 或 'multi' 则显示 ratio 的 R/G/B。
     """
     os.makedirs(out_dir, exist_ok=True)
+    plt = _plt()
     fig, axes = plt.subplots(2, 3, figsize=(16, 10))
     ax1, ax2, ax3, ax4, ax5, ax6 = axes.flatten()
 